@@ -0,0 +1,139 @@
+import logging
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# --- Adaptive Matching Cadence ---
+class AdaptiveMatchCadence:
+    """Reschedules the matching job from queue depth and recent arrival rate.
+
+    Arrivals are counted in memory as start_matching reports them (notify_arrival),
+    not re-derived from pending_matches, so the rate reflects real joins.
+
+    The scheduler still owns the job; after every cycle this picks the next
+    interval between the configured bounds and calls reschedule_job. An empty
+    queue backs off to the idle (max) interval, a growing queue tightens
+    towards the min interval.
+    """
+
+    def __init__(self, history_size=50):
+        self._lock = threading.Lock()
+        self._scheduler = None
+        self._job_id = None
+        self.enabled = False
+        self.base_seconds = 60
+        self.min_seconds = 15
+        self.max_seconds = 300
+        self.arrival_window_minutes = 5
+        self.pending_scale = 4
+        self.current_seconds = None
+        self.last_decision = None
+        self.history = deque(maxlen=history_size)
+        # time.time() of each rider that joined the queue, pruned to the arrival window
+        self._arrivals = deque()
+
+    def attach(self, scheduler, job_id, config):
+        """Binds to the scheduler job and reads bounds from the Flask config."""
+        with self._lock:
+            self._scheduler = scheduler
+            self._job_id = job_id
+            self.enabled = config['MATCH_ADAPTIVE_ENABLED']
+            self.base_seconds = config['MATCH_INTERVAL_MINUTES'] * 60
+            self.min_seconds = min(config['MATCH_INTERVAL_MIN_SECONDS'], self.base_seconds)
+            self.max_seconds = max(config['MATCH_INTERVAL_MAX_SECONDS'], self.base_seconds)
+            self.arrival_window_minutes = config['MATCH_ARRIVAL_WINDOW_MINUTES']
+            self.pending_scale = max(config['MATCH_ADAPTIVE_PENDING_SCALE'], 1)
+            self.current_seconds = self.base_seconds
+
+    def compute_interval(self, pending_count, arrivals_per_minute):
+        """Next interval in seconds for the given load. Pure function of the inputs and bounds."""
+        if pending_count == 0 and arrivals_per_minute == 0:
+            return self.max_seconds, 'idle'
+        if pending_count < 2 and arrivals_per_minute < 1:
+            # A lone rider can't be grouped until someone else arrives; wait at the base pace.
+            return self.base_seconds, 'waiting'
+        # Queued riders already include most recent arrivals, so take the larger of the two
+        # rather than their sum. interval = base / (1 + load): one pending_scale of load halves
+        # the base interval, two thirds it, and so on down to min_seconds.
+        expected = max(pending_count, arrivals_per_minute * self.arrival_window_minutes)
+        load = expected / self.pending_scale
+        seconds = self.base_seconds / (1 + load)
+        seconds = int(max(self.min_seconds, min(self.max_seconds, seconds)))
+        return seconds, 'busy' if seconds < self.base_seconds else 'normal'
+
+    def _reschedule(self, seconds, reason, pending_count, arrivals_per_minute):
+        decision = {
+            'at': datetime.now().isoformat(), 'interval_seconds': seconds, 'reason': reason,
+            'pending': pending_count, 'arrivals_per_minute': round(arrivals_per_minute, 2)
+        }
+        self.last_decision = decision
+        self.history.append(decision)
+        if seconds == self.current_seconds:
+            return
+        logger.info(f"[Cadence] Matching interval {self.current_seconds}s -> {seconds}s ({reason}, pending={pending_count}, arrivals/min={arrivals_per_minute:.2f})")
+        self.current_seconds = seconds
+        if self._scheduler is not None and self._scheduler.running:
+            try:
+                self._scheduler.reschedule_job(self._job_id, trigger='interval', seconds=seconds)
+            except Exception as e:
+                logger.error(f"[Cadence] Failed to reschedule '{self._job_id}': {e}")
+
+    def observe(self, db_instance):
+        """Measures the queue after a cycle and adjusts the job interval."""
+        if not self.enabled or db_instance is None:
+            return
+        try:
+            pending_count = db_instance.pending_matches.count_documents({})
+        except Exception as e:
+            logger.error(f"[Cadence] Failed to measure queue: {e}")
+            return
+        with self._lock:
+            self._prune_arrivals(time.time())
+            arrivals_per_minute = len(self._arrivals) / self.arrival_window_minutes
+            seconds, reason = self.compute_interval(pending_count, arrivals_per_minute)
+            self._reschedule(seconds, reason, pending_count, arrivals_per_minute)
+
+    def _prune_arrivals(self, now):
+        cutoff = now - self.arrival_window_minutes * 60
+        while self._arrivals and self._arrivals[0] < cutoff:
+            self._arrivals.popleft()
+
+    def notify_arrival(self):
+        """Called when a rider joins the queue; records the arrival and pulls an idle schedule back to the base interval."""
+        if not self.enabled:
+            return
+        with self._lock:
+            now = time.time()
+            self._arrivals.append(now)
+            self._prune_arrivals(now)
+            if self.current_seconds is not None and self.current_seconds > self.base_seconds:
+                self._reschedule(self.base_seconds, 'arrival', None, 0)
+
+    def wrap(self, job_func, db_getter):
+        """Returns a job callable that runs job_func and then re-evaluates the cadence."""
+        def run_adaptive_cycle():
+            try:
+                job_func()
+            finally:
+                self.observe(db_getter())
+        run_adaptive_cycle.__name__ = job_func.__name__
+        return run_adaptive_cycle
+
+    def get_status(self):
+        with self._lock:
+            next_run = None
+            if self._scheduler is not None:
+                job = self._scheduler.get_job(self._job_id)
+                if job is not None and job.next_run_time is not None:
+                    next_run = job.next_run_time.isoformat()
+            return {
+                'enabled': self.enabled, 'interval_seconds': self.current_seconds,
+                'bounds': {'min': self.min_seconds, 'base': self.base_seconds, 'max': self.max_seconds},
+                'next_run_time': next_run, 'last_decision': self.last_decision,
+                'recent_decisions': list(self.history)
+            }
+
+cadence = AdaptiveMatchCadence()
@@ -4,12 +4,13 @@ import os
 import logging
 import atexit
 
-from flask import Flask, current_app
+from flask import Flask, current_app, jsonify
 from pymongo import MongoClient, GEOSPHERE
 from apscheduler.schedulers.background import BackgroundScheduler
 from linebot import LineBotApi, WebhookHandler
 
 from config import Config
+import tracing
 
 # --- Globals for simplified access ---
 # These will be initialized in create_app
@@ -39,9 +40,14 @@ def create_app(config_class=Config):
         app.logger.critical(f"Configuration Error: {e}")
         exit(1)
 
+    # Initialize Tracing (before clients, so the Mongo listener and LINE API wrappers are installed)
+    tracing.configure(app.config['TRACE_SAMPLE_RATE'], app.config['TRACE_EXPORT_PATH'])
+    if app.config['TRACE_SAMPLE_RATE'] > 0:
+        app.logger.info(f"Tracing enabled: sampling {app.config['TRACE_SAMPLE_RATE']:.0%} to {app.config['TRACE_EXPORT_PATH']}")
+
     # Initialize MongoDB
     try:
-        client = MongoClient(app.config['MONGO_URI'])
+        client = MongoClient(app.config['MONGO_URI'], event_listeners=[tracing.MongoSpanListener()])
         client.server_info() # Verify connection
         db = client[app.config['MONGO_DB_NAME']]
         app.logger.info(f"Connected to MongoDB: {app.config['MONGO_DB_NAME']}")
@@ -53,7 +59,7 @@ def create_app(config_class=Config):
     # Initialize Line Bot API & Handler
     try:
         if app.config['LINE_CHANNEL_ACCESS_TOKEN'] and app.config['LINE_CHANNEL_SECRET']:
-            line_bot_api = LineBotApi(app.config['LINE_CHANNEL_ACCESS_TOKEN'])
+            line_bot_api = tracing.instrument_line_api(LineBotApi(app.config['LINE_CHANNEL_ACCESS_TOKEN']))
             handler = WebhookHandler(app.config['LINE_CHANNEL_SECRET'])
             app.logger.info("Line Bot API and Handler Initialized.")
         else:
@@ -65,21 +71,57 @@ def create_app(config_class=Config):
         line_bot_api = None
         handler = None
 
+    from load_shedding import admission
+    from adaptive_scheduler import cadence
+    admission.configure(app.config, db)
+
+    from geocoding import geocoder, create_backend
+    geocoder.configure(app.config, db, create_backend(app.config))
+
     # Import and Register Blueprints AFTER globals are set
     from webhook_handlers import webhook_bp
     app.register_blueprint(webhook_bp)
     app.logger.info("Webhook Blueprint registered.")
+    from demand_analytics import analytics_bp
+    app.register_blueprint(analytics_bp)
+    from match_status import status_bp
+    app.register_blueprint(status_bp)
 
     # Initialize and Start Scheduler
     from matching_logic import process_pending_matches # Import the job function
     scheduler = BackgroundScheduler(daemon=True)
+    adaptive_match_job = cadence.wrap(process_pending_matches, lambda: db)
     scheduler.add_job(
-        func=lambda: run_scheduled_job(app, process_pending_matches),
+        func=lambda: run_scheduled_job(app, adaptive_match_job),
         trigger="interval",
         minutes=app.config['MATCH_INTERVAL_MINUTES'],
         id="process_matches_job",
         replace_existing=True
     )
+    from match_lifecycle import process_match_lifecycle
+    scheduler.add_job(
+        func=lambda: run_scheduled_job(app, process_match_lifecycle),
+        trigger="interval",
+        minutes=app.config['MATCH_ARCHIVE_INTERVAL_MINUTES'],
+        id="match_lifecycle_job",
+        replace_existing=True
+    )
+    from notification_outbox import process_outbox
+    scheduler.add_job(
+        func=lambda: run_scheduled_job(app, process_outbox),
+        trigger="interval",
+        seconds=app.config['OUTBOX_INTERVAL_SECONDS'],
+        id="notification_outbox_job",
+        replace_existing=True
+    )
+    scheduler.add_job(
+        func=lambda: run_scheduled_job(app, admission.refresh_pending_depth),
+        trigger="interval",
+        seconds=app.config['PENDING_DEPTH_REFRESH_SECONDS'],
+        id="pending_depth_job",
+        replace_existing=True
+    )
+    cadence.attach(scheduler, "process_matches_job", app.config)
     # Only start scheduler if DB and API seem okay? Or let it run and log errors? Let it run for now.
     if db is not None and line_bot_api is not None:
          scheduler.start()
@@ -95,6 +137,14 @@ def create_app(config_class=Config):
     def index():
         return "Taxi Line Bot Service (Simplified) is Running!"
 
+    @app.route('/status/matcher')
+    def matcher_status():
+        return jsonify(cadence.get_status())
+
+    @app.route('/status/load')
+    def load_status():
+        return jsonify(admission.get_status())
+
     return app
 
 # --- Helper Functions ---
@@ -114,6 +164,15 @@ def initialize_database(db_instance, logger):
             db_instance.matches.create_index([("group_id", 1)], unique=True, background=True)
             logger.info("Created unique group_id index on 'matches'.")
         # feedbacks collection will be created on first insert
+        # Partial indexes for hot match lookups; create_index is idempotent, so also run on existing deployments.
+        from match_lifecycle import ensure_match_indexes
+        ensure_match_indexes(db_instance, logger)
+        from demand_analytics import ensure_analytics_indexes
+        ensure_analytics_indexes(db_instance, logger)
+        from notification_outbox import ensure_outbox_indexes
+        ensure_outbox_indexes(db_instance, logger, Config.OUTBOX_RETENTION_HOURS)
+        from geocoding import ensure_geocode_indexes
+        ensure_geocode_indexes(db_instance, logger, Config.GEOCODE_CACHE_TTL_DAYS)
     except Exception as e:
         logger.error(f"Error during database indexing: {e}")
 
@@ -125,7 +184,8 @@ def run_scheduled_job(app_context, job_func):
             if db is None:
                  current_app.logger.error(f"Scheduled job '{job_func.__name__}' skipped: DB not available.")
                  return
-            job_func()
+            with tracing.trace_root(f"job.{job_func.__name__}"):
+                job_func()
         except Exception as e:
              current_app.logger.exception(f"Exception in scheduled job '{job_func.__name__}': {e}")
 
@@ -22,10 +22,72 @@ class Config:
     # Google Maps API Key (config 會讀取，即使模板不用)
     Maps_API_KEY = os.environ.get('Maps_API_KEY')
 
+    # Reverse Geocoding ('google', 'stub' or 'none')
+    GEOCODING_BACKEND = os.environ.get('GEOCODING_BACKEND', 'google' if Maps_API_KEY else 'none').lower()
+    GEOCODE_CACHE_PRECISION = int(os.environ.get('GEOCODE_CACHE_PRECISION', 3))
+    GEOCODE_CACHE_MAX_ENTRIES = int(os.environ.get('GEOCODE_CACHE_MAX_ENTRIES', 10000))
+    GEOCODE_CACHE_TTL_DAYS = int(os.environ.get('GEOCODE_CACHE_TTL_DAYS', 30))
+
     # Matching Settings
     MATCH_INTERVAL_MINUTES = int(os.environ.get('MATCH_INTERVAL_MINUTES', 1))
     MATCH_TIMEOUT_MINUTES = int(os.environ.get('MATCH_TIMEOUT_MINUTES', 10))
     DESTINATION_PRECISION = int(os.environ.get('DESTINATION_PRECISION', 4))
+    MATCH_PRIORITY_PARTY_WEIGHT_SECONDS = int(os.environ.get('MATCH_PRIORITY_PARTY_WEIGHT_SECONDS', 60))
+    MATCH_RELAX_AFTER_MINUTES = int(os.environ.get('MATCH_RELAX_AFTER_MINUTES', 3))
+    MATCH_RELAX_MAX_STEPS = int(os.environ.get('MATCH_RELAX_MAX_STEPS', 2))
+    MATCH_SERVER_SIDE_GROUPING = os.environ.get('MATCH_SERVER_SIDE_GROUPING', 'False').lower() == 'true'
+    MATCH_AGGREGATION_BATCH_SIZE = int(os.environ.get('MATCH_AGGREGATION_BATCH_SIZE', 200))
+    MATCH_ADAPTIVE_ENABLED = os.environ.get('MATCH_ADAPTIVE_ENABLED', 'True').lower() == 'true'
+    MATCH_INTERVAL_MIN_SECONDS = int(os.environ.get('MATCH_INTERVAL_MIN_SECONDS', 15))
+    MATCH_INTERVAL_MAX_SECONDS = int(os.environ.get('MATCH_INTERVAL_MAX_SECONDS', 300))
+    MATCH_ARRIVAL_WINDOW_MINUTES = int(os.environ.get('MATCH_ARRIVAL_WINDOW_MINUTES', 5))
+    MATCH_ADAPTIVE_PENDING_SCALE = int(os.environ.get('MATCH_ADAPTIVE_PENDING_SCALE', 4))
+
+    # Route Compatibility Scoring (orders partners in relaxed buckets; fine buckets stay in wait-time order)
+    ROUTE_SCORING_ENABLED = os.environ.get('ROUTE_SCORING_ENABLED', 'True').lower() == 'true'
+    ROUTE_MAX_DEST_DISTANCE_M = float(os.environ.get('ROUTE_MAX_DEST_DISTANCE_M', 500))
+    ROUTE_MAX_DETOUR_RATIO = float(os.environ.get('ROUTE_MAX_DETOUR_RATIO', 0.5))
+    ROUTE_SCORE_TOP_K = int(os.environ.get('ROUTE_SCORE_TOP_K', 16))
+    ROUTE_SCORE_CHUNK_ROWS = int(os.environ.get('ROUTE_SCORE_CHUNK_ROWS', 64))
+    PICKUP_MAX_AGE_MINUTES = int(os.environ.get('PICKUP_MAX_AGE_MINUTES', 30)) # A shared pickup older than this is not used as the trip origin
+
+    # Match Lifecycle / Archiving
+    MATCH_EXPIRE_AFTER_HOURS = int(os.environ.get('MATCH_EXPIRE_AFTER_HOURS', 6))
+    MATCH_ARCHIVE_AFTER_HOURS = int(os.environ.get('MATCH_ARCHIVE_AFTER_HOURS', 24))
+    MATCH_ARCHIVE_INTERVAL_MINUTES = int(os.environ.get('MATCH_ARCHIVE_INTERVAL_MINUTES', 30))
+    MATCH_ARCHIVE_BATCH_SIZE = int(os.environ.get('MATCH_ARCHIVE_BATCH_SIZE', 500))
+    MATCH_ARCHIVE_MODE = os.environ.get('MATCH_ARCHIVE_MODE', 'archive').lower() # 'archive' or 'summary'
+
+    # Webhook Load Shedding
+    WEBHOOK_SOFT_CONCURRENCY = int(os.environ.get('WEBHOOK_SOFT_CONCURRENCY', 8))
+    WEBHOOK_HARD_CONCURRENCY = int(os.environ.get('WEBHOOK_HARD_CONCURRENCY', 16))
+    WEBHOOK_MAX_CONCURRENCY = int(os.environ.get('WEBHOOK_MAX_CONCURRENCY', 32))
+    PENDING_SOFT_DEPTH = int(os.environ.get('PENDING_SOFT_DEPTH', 200))
+    PENDING_HARD_DEPTH = int(os.environ.get('PENDING_HARD_DEPTH', 1000))
+    PENDING_DEPTH_REFRESH_SECONDS = int(os.environ.get('PENDING_DEPTH_REFRESH_SECONDS', 10))
+    WEBHOOK_DEFER_WORKERS = int(os.environ.get('WEBHOOK_DEFER_WORKERS', 4))
+    WEBHOOK_DEFER_QUEUE_SIZE = int(os.environ.get('WEBHOOK_DEFER_QUEUE_SIZE', 500))
+
+    # Live Matching Status (LIFF)
+    LIFF_STATUS_URL = os.environ.get('LIFF_STATUS_URL') # e.g. https://liff.line.me/<liff-id>
+    STATUS_LONG_POLL_SECONDS = int(os.environ.get('STATUS_LONG_POLL_SECONDS', 25))
+    STATUS_STREAM_MAX_SECONDS = int(os.environ.get('STATUS_STREAM_MAX_SECONDS', 300))
+
+    # Notification Outbox
+    OUTBOX_INTERVAL_SECONDS = int(os.environ.get('OUTBOX_INTERVAL_SECONDS', 2))
+    OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', 200))
+    OUTBOX_LEASE_SECONDS = int(os.environ.get('OUTBOX_LEASE_SECONDS', 60))
+    OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 5))
+    OUTBOX_RETRY_SECONDS = int(os.environ.get('OUTBOX_RETRY_SECONDS', 5))
+    OUTBOX_RETENTION_HOURS = int(os.environ.get('OUTBOX_RETENTION_HOURS', 72))
+
+    # Tracing (0 disables; spans are appended to TRACE_EXPORT_PATH as JSONL)
+    TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', 0))
+    TRACE_EXPORT_PATH = os.environ.get('TRACE_EXPORT_PATH', os.path.join(basedir, 'traces.jsonl'))
+
+    # Demand Analytics
+    ANALYTICS_CELL_PRECISION = int(os.environ.get('ANALYTICS_CELL_PRECISION', 2))
+    ANALYTICS_API_TOKEN = os.environ.get('ANALYTICS_API_TOKEN')
 
     @staticmethod
     def check_essential_configs():
@@ -0,0 +1,170 @@
+import hmac
+import logging
+from datetime import datetime, timedelta
+from flask import Blueprint, request, jsonify, abort, current_app
+from pymongo import UpdateOne
+from app import db
+
+logger = logging.getLogger(__name__)
+analytics_bp = Blueprint('analytics', __name__)
+
+# Upper bounds (minutes) of the wait-time histogram buckets; anything longer falls into 'gt_<last>'.
+WAIT_HISTOGRAM_BOUNDS = [1, 2, 5, 10, 20]
+HEATMAP_METRICS = ['requests', 'matches', 'matched_riders', 'timeouts']
+
+# --- Bucketing Helpers ---
+def cell_key(lon, lat, precision):
+    """Spatial cell of a coordinate, e.g. '121.54,25.03' for precision 2 (~1 km)."""
+    return f"{float(lon):.{precision}f},{float(lat):.{precision}f}"
+
+def hour_bucket(ts):
+    return ts.replace(minute=0, second=0, microsecond=0)
+
+def wait_bucket(wait_seconds):
+    minutes = wait_seconds / 60
+    for bound in WAIT_HISTOGRAM_BOUNDS:
+        if minutes < bound:
+            return f"lt_{bound}"
+    return f"gt_{WAIT_HISTOGRAM_BOUNDS[-1]}"
+
+# --- Per-Cycle Accumulator ---
+class DemandRollup:
+    """Collects counters during one matching cycle and writes them as a single bulk $inc."""
+
+    def __init__(self, precision, now=None):
+        self.precision = precision
+        self.now = now or datetime.now()
+        self._buckets = {}
+
+    def _bucket(self, dest_coords, ts):
+        lon, lat = float(dest_coords[0]), float(dest_coords[1])
+        key = (cell_key(lon, lat, self.precision), hour_bucket(ts))
+        if key not in self._buckets:
+            self._buckets[key] = {'inc': {}, 'center': [round(lon, self.precision), round(lat, self.precision)]}
+        return self._buckets[key]['inc']
+
+    def _add(self, dest_coords, ts, field, amount=1):
+        if not dest_coords or len(dest_coords) != 2:
+            return
+        try:
+            inc = self._bucket(dest_coords, ts)
+        except (ValueError, TypeError):
+            return
+        inc[field] = inc.get(field, 0) + amount
+
+    def record_request(self, pending_doc):
+        self._add(pending_doc.get('destination'), pending_doc.get('timestamp') or self.now, 'requests')
+
+    def record_timeout(self, pending_doc):
+        self._add(pending_doc.get('destination'), self.now, 'timeouts')
+
+    def record_match(self, dest_coords, group_docs):
+        self._add(dest_coords, self.now, 'matches')
+        for p in group_docs:
+            self._add(dest_coords, self.now, 'matched_riders')
+            ts = p.get('timestamp')
+            if ts is None:
+                continue
+            wait_seconds = max((self.now - ts).total_seconds(), 0)
+            self._add(dest_coords, self.now, f"wait_hist.{wait_bucket(wait_seconds)}")
+            self._add(dest_coords, self.now, 'wait_seconds_sum', wait_seconds)
+
+    def flush(self, db_instance):
+        """Writes accumulated counters. Returns the number of buckets touched."""
+        if db_instance is None or not self._buckets:
+            return 0
+        ops = [
+            UpdateOne(
+                {'cell': cell, 'hour': hour},
+                {'$inc': bucket['inc'], '$setOnInsert': {'center': bucket['center']}},
+                upsert=True
+            )
+            for (cell, hour), bucket in self._buckets.items() if bucket['inc']
+        ]
+        if ops:
+            db_instance.demand_stats.bulk_write(ops, ordered=False)
+        touched = len(ops)
+        self._buckets = {}
+        return touched
+
+# --- Request Counting ---
+def record_request(db_instance, pending_doc, precision):
+    """Counts one new pending request as it is inserted (a single $inc upsert).
+
+    Counting at insert time covers requests that are cancelled, or that time out,
+    before the matcher ever sees them. Never raises, so analytics can't break start_matching.
+    """
+    rollup = DemandRollup(precision)
+    rollup.record_request(pending_doc)
+    try:
+        rollup.flush(db_instance)
+    except Exception as e:
+        logger.error(f"Failed to count request for {pending_doc.get('line_user_id')}: {e}")
+
+def ensure_analytics_indexes(db_instance, logger):
+    if db_instance is None: return
+    try:
+        db_instance.demand_stats.create_index([("cell", 1), ("hour", 1)], unique=True, background=True)
+        db_instance.demand_stats.create_index([("hour", 1)], background=True)
+        logger.info("Ensured indexes on 'demand_stats'.")
+    except Exception as e:
+        logger.error(f"Error creating demand_stats indexes: {e}")
+
+# --- Read API ---
+def get_demand_heatmap(since, until=None, metric='requests', limit=500):
+    """Per-cell totals over [since, until), ordered by the chosen metric."""
+    hour_filter = {'$gte': hour_bucket(since)}
+    if until is not None:
+        hour_filter['$lt'] = until
+    pipeline = [
+        {'$match': {'hour': hour_filter}},
+        {'$group': {
+            '_id': '$cell', 'center': {'$first': '$center'},
+            'requests': {'$sum': '$requests'}, 'matches': {'$sum': '$matches'},
+            'matched_riders': {'$sum': '$matched_riders'}, 'timeouts': {'$sum': '$timeouts'},
+            'wait_seconds_sum': {'$sum': '$wait_seconds_sum'},
+            **{f"wait_{k}": {'$sum': f"$wait_hist.{k}"} for k in _histogram_keys()}
+        }},
+        {'$sort': {metric: -1}},
+        {'$limit': limit}
+    ]
+    cells = []
+    for row in db.demand_stats.aggregate(pipeline):
+        riders = row.get('matched_riders', 0)
+        resolved = riders + row.get('timeouts', 0)
+        cells.append({
+            'cell': row['_id'], 'center': row.get('center'),
+            'requests': row.get('requests', 0), 'matches': row.get('matches', 0),
+            'matched_riders': riders, 'timeouts': row.get('timeouts', 0),
+            'match_rate': round(riders / resolved, 3) if resolved else None,
+            'avg_wait_seconds': round(row.get('wait_seconds_sum', 0) / riders, 1) if riders else None,
+            'wait_histogram': {k: row.get(f"wait_{k}", 0) for k in _histogram_keys()}
+        })
+    return cells
+
+def _histogram_keys():
+    return [f"lt_{b}" for b in WAIT_HISTOGRAM_BOUNDS] + [f"gt_{WAIT_HISTOGRAM_BOUNDS[-1]}"]
+
+@analytics_bp.route("/analytics/heatmap", methods=['GET'])
+def heatmap():
+    if db is None:
+        abort(503)
+    # Disabled unless a token is configured; demand data reveals rider destinations
+    token = current_app.config.get('ANALYTICS_API_TOKEN')
+    if not token:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+        abort(401)
+
+    metric = request.args.get('metric', 'requests')
+    if metric not in HEATMAP_METRICS:
+        abort(400)
+    try:
+        hours = max(1, min(int(request.args.get('hours', 24)), 24 * 31))
+        limit = max(1, min(int(request.args.get('limit', 500)), 5000))
+    except ValueError:
+        abort(400)
+
+    since = datetime.now() - timedelta(hours=hours)
+    cells = get_demand_heatmap(since, metric=metric, limit=limit)
+    return jsonify({'since': since.isoformat(), 'metric': metric, 'cells': cells})
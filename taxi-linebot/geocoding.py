@@ -0,0 +1,159 @@
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime
+import requests
+
+logger = logging.getLogger(__name__)
+
+# --- Backends ---
+class GoogleGeocodingBackend:
+    """Reverse geocoding through the Google Geocoding API."""
+    API_URL = "https://maps.googleapis.com/maps/api/geocode/json"
+
+    def __init__(self, api_key, language='zh-TW', timeout=5):
+        self.api_key = api_key
+        self.language = language
+        self.timeout = timeout
+
+    def reverse(self, lat, lon):
+        params = {'latlng': f"{lat},{lon}", 'key': self.api_key, 'language': self.language}
+        try:
+            response = requests.get(self.API_URL, params=params, timeout=self.timeout)
+            response.raise_for_status()
+            data = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.error(f"Reverse geocoding failed for ({lat:.5f}, {lon:.5f}): {e}")
+            return None
+        if data.get('status') != 'OK' or not data.get('results'):
+            logger.warning(f"Reverse geocoding returned {data.get('status')} for ({lat:.5f}, {lon:.5f}).")
+            return None
+        return data['results'][0].get('formatted_address')
+
+class StubGeocodingBackend:
+    """Local backend for development and tests: a fixed mapping or callable, no network."""
+
+    def __init__(self, resolver=None):
+        self.resolver = resolver
+        self.calls = 0
+
+    def reverse(self, lat, lon):
+        self.calls += 1
+        if callable(self.resolver):
+            return self.resolver(lat, lon)
+        if isinstance(self.resolver, dict):
+            return self.resolver.get((round(lat, 3), round(lon, 3)))
+        return f"測試地址 ({lat:.3f}, {lon:.3f})"
+
+# --- Service ---
+class GeocodingService:
+    """Reverse geocoding behind a spatially keyed two-level cache.
+
+    Coordinates are snapped to a grid cell (cache_precision decimal places, ~110 m
+    at 3), so nearby points share one entry. Lookups go memory LRU -> Mongo
+    'geocode_cache' -> backend; backend results are written to both levels.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self.backend = None
+        self.db = None
+        self.cache_precision = 3
+        self.max_entries = 10000
+        self.stats = {'memory_hits': 0, 'db_hits': 0, 'backend_calls': 0, 'misses': 0}
+
+    def configure(self, config, db_instance, backend=None):
+        self.db = db_instance
+        self.cache_precision = config['GEOCODE_CACHE_PRECISION']
+        self.max_entries = config['GEOCODE_CACHE_MAX_ENTRIES']
+        self.backend = backend
+
+    def set_backend(self, backend):
+        self.backend = backend
+
+    def cell_key(self, lat, lon):
+        return f"{lat:.{self.cache_precision}f},{lon:.{self.cache_precision}f}"
+
+    def _remember_in_memory(self, key, address):
+        with self._lock:
+            self._memory[key] = address
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def _persist(self, key, lat, lon, address, source):
+        if self.db is None: return
+        try:
+            self.db.geocode_cache.update_one(
+                {'_id': key},
+                {'$set': {'address': address, 'lat': lat, 'lon': lon, 'source': source, 'updated_at': datetime.now()}},
+                upsert=True
+            )
+        except Exception as e:
+            logger.error(f"Failed to persist geocode cache entry {key}: {e}")
+
+    def remember(self, lat, lon, address, source='line'):
+        """Seeds the cache with an address we already know (e.g. one LINE sent with the location)."""
+        if not address: return
+        key = self.cell_key(lat, lon)
+        with self._lock:
+            known = self._memory.get(key) == address
+        if known: return
+        self._remember_in_memory(key, address)
+        self._persist(key, lat, lon, address, source)
+
+    def reverse(self, lat, lon, allow_remote=True):
+        """Address for the coordinate, or None. allow_remote=False restricts to cached results."""
+        key = self.cell_key(lat, lon)
+        with self._lock:
+            address = self._memory.get(key)
+            if address is not None:
+                self._memory.move_to_end(key)
+                self.stats['memory_hits'] += 1
+                return address
+
+        if self.db is not None:
+            try:
+                doc = self.db.geocode_cache.find_one({'_id': key}, {'address': 1})
+            except Exception as e:
+                logger.error(f"Geocode cache lookup failed for {key}: {e}")
+                doc = None
+            if doc and doc.get('address'):
+                self.stats['db_hits'] += 1
+                self._remember_in_memory(key, doc['address'])
+                return doc['address']
+
+        if not allow_remote or self.backend is None:
+            self.stats['misses'] += 1
+            return None
+        self.stats['backend_calls'] += 1
+        address = self.backend.reverse(lat, lon)
+        if address:
+            self._remember_in_memory(key, address)
+            self._persist(key, lat, lon, address, type(self.backend).__name__)
+        else:
+            self.stats['misses'] += 1
+        return address
+
+def ensure_geocode_indexes(db_instance, logger, ttl_days):
+    if db_instance is None: return
+    try:
+        db_instance.geocode_cache.create_index([("updated_at", 1)], expireAfterSeconds=ttl_days * 86400, background=True)
+        logger.info("Ensured TTL index on 'geocode_cache'.")
+    except Exception as e:
+        logger.error(f"Error creating geocode_cache index: {e}")
+
+def create_backend(config):
+    """Backend selected by GEOCODING_BACKEND ('google', 'stub' or 'none')."""
+    name = config['GEOCODING_BACKEND']
+    if name == 'stub':
+        return StubGeocodingBackend()
+    if name == 'google':
+        if not config.get('Maps_API_KEY'):
+            logger.warning("GEOCODING_BACKEND is 'google' but Maps_API_KEY is not set; geocoding will use the cache only.")
+            return None
+        return GoogleGeocodingBackend(config['Maps_API_KEY'])
+    return None
+
+geocoder = GeocodingService()
@@ -0,0 +1,131 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from linebot.models import TextSendMessage
+
+logger = logging.getLogger(__name__)
+
+# Degradation levels, in order of severity
+LEVEL_NORMAL = 0   # everything as usual
+LEVEL_REDUCED = 1  # skip the loading indicator HTTP call
+LEVEL_BUSY = 2     # start_matching gets a cached "busy, queued" reply instead of the flex
+LEVEL_SHED = 3     # callbacks are acknowledged immediately and handled by the deferral pool
+LEVEL_NAMES = {LEVEL_NORMAL: 'normal', LEVEL_REDUCED: 'reduced', LEVEL_BUSY: 'busy', LEVEL_SHED: 'shed'}
+
+# Built once; replying with it needs no template work
+BUSY_QUEUED_MESSAGE = TextSendMessage(text="🚦 目前使用人數眾多，您已加入配對佇列，配對完成後會通知您，請稍候。")
+
+# --- Admission Control ---
+class AdmissionController:
+    """Tracks in-flight webhook requests and pending-queue depth to pick a degradation level.
+
+    Queue depth is kept here rather than borrowed from the matcher: handlers and
+    the matcher report joins and removals as they happen, and a periodic count
+    (refresh_pending_depth) corrects any drift, e.g. from other processes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.deferred = 0
+        self.deferred_dropped = 0
+        self.soft_concurrency = 8
+        self.hard_concurrency = 16
+        self.max_concurrency = 32
+        self.pending_soft = 200
+        self.pending_hard = 1000
+        self.defer_queue_size = 500
+        self._executor = None
+        self._db = None
+        self.pending_depth = None  # None until the first count
+
+    def configure(self, config, db_instance=None):
+        self.soft_concurrency = config['WEBHOOK_SOFT_CONCURRENCY']
+        self.hard_concurrency = max(config['WEBHOOK_HARD_CONCURRENCY'], self.soft_concurrency)
+        self.max_concurrency = max(config['WEBHOOK_MAX_CONCURRENCY'], self.hard_concurrency)
+        self.pending_soft = config['PENDING_SOFT_DEPTH']
+        self.pending_hard = max(config['PENDING_HARD_DEPTH'], self.pending_soft)
+        self.defer_queue_size = config['WEBHOOK_DEFER_QUEUE_SIZE']
+        self._executor = ThreadPoolExecutor(max_workers=config['WEBHOOK_DEFER_WORKERS'], thread_name_prefix='webhook-deferred')
+        self._db = db_instance
+        self.refresh_pending_depth()
+
+    def refresh_pending_depth(self):
+        """Re-counts pending_matches from collection metadata (no scan); run on a timer."""
+        if self._db is None:
+            return
+        try:
+            depth = self._db.pending_matches.estimated_document_count()
+        except Exception as e:
+            logger.error(f"Failed to count pending requests: {e}")
+            return
+        with self._lock:
+            self.pending_depth = depth
+
+    def note_pending(self, delta):
+        """Adjusts the tracked depth when requests join (+) or leave (-) the queue."""
+        if not delta:
+            return
+        with self._lock:
+            if self.pending_depth is not None:
+                self.pending_depth = max(self.pending_depth + delta, 0)
+
+    def level(self, in_flight=None):
+        """Current degradation level from concurrency and the last observed pending depth."""
+        in_flight = self.in_flight if in_flight is None else in_flight
+        pending = self.pending_depth or 0
+        if in_flight > self.max_concurrency:
+            return LEVEL_SHED
+        if in_flight > self.hard_concurrency or pending >= self.pending_hard:
+            return LEVEL_BUSY
+        if in_flight > self.soft_concurrency or pending >= self.pending_soft:
+            return LEVEL_REDUCED
+        return LEVEL_NORMAL
+
+    @contextmanager
+    def admit(self):
+        """Counts the request as in flight and yields the level it was admitted at."""
+        with self._lock:
+            self.in_flight += 1
+            current = self.in_flight
+        try:
+            yield self.level(current)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def defer(self, app, func, *args):
+        """Runs func later on the deferral pool inside an app context. False if the pool is full."""
+        with self._lock:
+            if self._executor is None or self.deferred >= self.defer_queue_size:
+                self.deferred_dropped += 1
+                return False
+            self.deferred += 1
+
+        def run():
+            try:
+                with app.app_context():
+                    func(*args)
+            except Exception as e:
+                logger.exception(f"Deferred webhook handling failed: {e}")
+            finally:
+                with self._lock:
+                    self.deferred -= 1
+
+        self._executor.submit(run)
+        return True
+
+    def get_status(self):
+        level = self.level()
+        return {
+            'level': level, 'level_name': LEVEL_NAMES[level],
+            'in_flight': self.in_flight, 'deferred': self.deferred, 'deferred_dropped': self.deferred_dropped,
+            'pending_depth': self.pending_depth,
+            'thresholds': {
+                'soft_concurrency': self.soft_concurrency, 'hard_concurrency': self.hard_concurrency,
+                'max_concurrency': self.max_concurrency, 'pending_soft': self.pending_soft, 'pending_hard': self.pending_hard
+            }
+        }
+
+admission = AdmissionController()
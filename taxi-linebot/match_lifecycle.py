@@ -0,0 +1,139 @@
+import logging
+from datetime import datetime, timedelta
+from flask import current_app
+from pymongo import ReplaceOne, UpdateOne
+from app import db
+import message_templates
+
+logger = logging.getLogger(__name__)
+
+# Statuses that hot-path queries care about. Everything else is history and may be moved out of 'matches'.
+HOT_MATCH_STATUSES = [message_templates.MATCH_STATUS_ACTIVE, message_templates.STATE_AWAITING_PLATE]
+
+ARCHIVE_MODE_ARCHIVE = 'archive'
+ARCHIVE_MODE_SUMMARY = 'summary'
+
+# --- Index Setup ---
+def ensure_match_indexes(db_instance, logger):
+    """Creates the partial indexes used by hot-path match lookups.
+
+    Only hot matches are indexed, so the index size tracks the number of live
+    groups rather than the whole match history.
+    """
+    if db_instance is None: return
+    # One partial index per hot status: partial filters with $in need MongoDB 6.0+
+    specs = [
+        (db_instance.matches, [("members", 1)], {'name': "members_active", 'partialFilterExpression': {'status': message_templates.MATCH_STATUS_ACTIVE}}),
+        (db_instance.matches, [("members", 1)], {'name': "members_awaiting_plate", 'partialFilterExpression': {'status': message_templates.STATE_AWAITING_PLATE}}),
+        (db_instance.matches, [("leader_id", 1)], {'name': "leader_awaiting_plate", 'partialFilterExpression': {'status': message_templates.STATE_AWAITING_PLATE}}),
+        (db_instance.matches, [("created_at", 1)], {}),
+        (db_instance.matches_archive, [("created_at", 1)], {}),
+        (db_instance.match_daily_summaries, [("date", 1)], {'unique': True}),
+    ]
+    for collection, keys, options in specs:
+        try:
+            collection.create_index(keys, background=True, **options)
+        except Exception as e:
+            logger.error(f"Error creating index {keys} on '{collection.name}': {e}")
+    logger.info("Ensured lifecycle indexes on 'matches'.")
+
+def hot_member_filter(user_id):
+    """Query for user_id's hot match, one $or branch per status so each can use its partial index."""
+    return {'$or': [{'members': user_id, 'status': status} for status in HOT_MATCH_STATUSES]}
+
+# --- Lifecycle Transitions ---
+def expire_stale_matches(expire_after_hours):
+    """Closes hot matches older than the expiry window.
+
+    Groups whose leader registered a plate are treated as completed trips, the rest as expired.
+    Returns the number of matches transitioned.
+    """
+    cutoff = datetime.now() - timedelta(hours=expire_after_hours)
+    now = datetime.now()
+    completed = db.matches.update_many(
+        {'status': {'$in': HOT_MATCH_STATUSES}, 'created_at': {'$lt': cutoff}, 'license_plate': {'$exists': True}},
+        {'$set': {'status': message_templates.MATCH_STATUS_COMPLETED, 'ended_at': now}}
+    ).modified_count
+    expired = db.matches.update_many(
+        {'status': {'$in': HOT_MATCH_STATUSES}, 'created_at': {'$lt': cutoff}},
+        {'$set': {'status': message_templates.MATCH_STATUS_EXPIRED, 'ended_at': now}}
+    ).modified_count
+    if completed or expired:
+        logger.info(f"[Archiver] Closed stale matches: {completed} completed, {expired} expired.")
+    return completed + expired
+
+def _archive_batch(batch):
+    """Copies a batch into 'matches_archive'. Upserts by _id so a crash before the delete is harmless."""
+    db.matches_archive.bulk_write([ReplaceOne({'_id': m['_id']}, m, upsert=True) for m in batch], ordered=False)
+
+def _summarize_batch(batch):
+    """Folds a batch into per-day counters in 'match_daily_summaries'."""
+    days = {}
+    for m in batch:
+        created_at = m.get('created_at') or datetime.now()
+        day = created_at.strftime("%Y-%m-%d")
+        status = m.get('status') or 'unknown'
+        summary = days.setdefault(day, {'matches': 0, 'passengers': 0, 'members': 0, 'statuses': {}})
+        summary['matches'] += 1
+        summary['passengers'] += m.get('total_passengers', 0) or 0
+        summary['members'] += len(m.get('members', []))
+        summary['statuses'][status] = summary['statuses'].get(status, 0) + 1
+
+    ops = []
+    for day, summary in days.items():
+        inc = {'matches': summary['matches'], 'total_passengers': summary['passengers'], 'total_members': summary['members']}
+        for status, count in summary['statuses'].items():
+            inc[f"by_status.{status}"] = count
+        ops.append(UpdateOne({'date': day}, {'$inc': inc, '$set': {'updated_at': datetime.now()}}, upsert=True))
+    if ops:
+        db.match_daily_summaries.bulk_write(ops, ordered=False)
+
+def archive_inactive_matches(archive_after_hours, batch_size, mode=ARCHIVE_MODE_ARCHIVE):
+    """Moves non-hot matches older than the retention window out of 'matches'.
+
+    In 'archive' mode documents are copied verbatim into 'matches_archive'; in
+    'summary' mode they are compacted into daily counters. Returns the number removed.
+    """
+    cutoff = datetime.now() - timedelta(hours=archive_after_hours)
+    query = {'status': {'$nin': HOT_MATCH_STATUSES}, 'created_at': {'$lt': cutoff}}
+    total_removed = 0
+    while True:
+        batch = list(db.matches.find(query).sort('created_at', 1).limit(batch_size))
+        if not batch:
+            break
+        if mode == ARCHIVE_MODE_SUMMARY:
+            # Counters are not idempotent, so only count documents we actually delete below.
+            ids = [m['_id'] for m in batch]
+            removed = db.matches.delete_many({'_id': {'$in': ids}, **query}).deleted_count
+            if removed != len(batch):
+                still_there = set(d['_id'] for d in db.matches.find({'_id': {'$in': ids}}, {'_id': 1}))
+                batch = [m for m in batch if m['_id'] not in still_there]
+            _summarize_batch(batch)
+        else:
+            _archive_batch(batch)
+            removed = db.matches.delete_many({'_id': {'$in': [m['_id'] for m in batch]}, **query}).deleted_count
+        total_removed += removed
+        if len(batch) < batch_size:
+            break
+    if total_removed:
+        logger.info(f"[Archiver] Moved {total_removed} inactive matches out of 'matches' (mode={mode}).")
+    return total_removed
+
+# --- Scheduled Job ---
+def process_match_lifecycle():
+    """Expires stale matches and archives history, run by the scheduler."""
+    if db is None:
+        logger.error("[Archiver] DB not available, skipping lifecycle processing.")
+        return
+
+    with current_app.app_context():
+        mode = current_app.config['MATCH_ARCHIVE_MODE']
+        if mode not in (ARCHIVE_MODE_ARCHIVE, ARCHIVE_MODE_SUMMARY):
+            logger.warning(f"[Archiver] Unknown MATCH_ARCHIVE_MODE '{mode}', falling back to '{ARCHIVE_MODE_ARCHIVE}'.")
+            mode = ARCHIVE_MODE_ARCHIVE
+        expire_stale_matches(current_app.config['MATCH_EXPIRE_AFTER_HOURS'])
+        archive_inactive_matches(
+            current_app.config['MATCH_ARCHIVE_AFTER_HOURS'],
+            current_app.config['MATCH_ARCHIVE_BATCH_SIZE'],
+            mode
+        )
@@ -0,0 +1,68 @@
+import logging
+from pymongo import ReturnDocument
+from app import db
+import message_templates
+from match_lifecycle import HOT_MATCH_STATUSES
+
+logger = logging.getLogger(__name__)
+
+# Outcomes of leave_match
+LEAVE_OK = 'left'
+LEAVE_CANCELLED = 'left_and_cancelled'
+LEAVE_NOT_MEMBER = 'not_member'
+LEAVE_NOT_FOUND = 'not_found'
+
+# --- Membership Operations ---
+def leave_match(match_id, user_id):
+    """Removes user_id from a live match in one atomic round-trip.
+
+    The pipeline update pulls the member and, if one or fewer remain, flips the
+    status to cancelled in the same write, so concurrent leavers can never both
+    see "two left" and skip the cancellation. A leaving leader hands the role to
+    the first remaining member and is recorded as previous_leader_id.
+    Returns (outcome, match_after).
+    """
+    match = db.matches.find_one_and_update(
+        {'group_id': match_id, 'status': {'$in': HOT_MATCH_STATUSES}, 'members': user_id},
+        [
+            {'$set': {'members': {'$filter': {'input': '$members', 'cond': {'$ne': ['$$this', user_id]}}}}},
+            {'$set': {
+                'previous_leader_id': {'$cond': [{'$eq': ['$leader_id', user_id]}, user_id, '$previous_leader_id']},
+                'leader_id': {'$cond': [{'$eq': ['$leader_id', user_id]}, {'$arrayElemAt': ['$members', 0]}, '$leader_id']}
+            }},
+            {'$set': {'status': {'$cond': [
+                {'$lte': [{'$size': '$members'}, 1]},
+                message_templates.MATCH_STATUS_CANCELLED,
+                '$status'
+            ]}}}
+        ],
+        return_document=ReturnDocument.AFTER
+    )
+    if match is not None:
+        if match.get('status') == message_templates.MATCH_STATUS_CANCELLED:
+            logger.info(f"User {user_id} left match {match_id}; match cancelled due to insufficient members.")
+            return LEAVE_CANCELLED, match
+        logger.info(f"User {user_id} left match {match_id}")
+        return LEAVE_OK, match
+
+    # Cold path: only hit when the conditional update matched nothing.
+    existing = db.matches.find_one({'group_id': match_id, 'status': {'$in': HOT_MATCH_STATUSES}}, {'_id': 1})
+    return (LEAVE_NOT_MEMBER if existing else LEAVE_NOT_FOUND), None
+
+def register_license_plate(leader_id, license_plate):
+    """Stores the plate on the leader's awaiting match and reactivates it in one round-trip.
+
+    Returns the updated match, or None if leader_id has no match awaiting a plate.
+    """
+    match = db.matches.find_one_and_update(
+        {'leader_id': leader_id, 'status': message_templates.STATE_AWAITING_PLATE},
+        {'$set': {'license_plate': license_plate, 'status': message_templates.MATCH_STATUS_ACTIVE}},
+        return_document=ReturnDocument.AFTER
+    )
+    if match is not None:
+        logger.info(f"Leader {leader_id} provided license plate {license_plate} for match {match['group_id']}")
+    return match
+
+def is_awaiting_plate(leader_id):
+    """True if leader_id leads a match that still needs a license plate."""
+    return db.matches.find_one({'leader_id': leader_id, 'status': message_templates.STATE_AWAITING_PLATE}, {'_id': 1}) is not None
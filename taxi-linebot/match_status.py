@@ -0,0 +1,208 @@
+import json
+import logging
+import threading
+import time
+import requests
+from flask import Blueprint, Response, request, jsonify, abort, current_app, stream_with_context
+from app import db
+from match_lifecycle import hot_member_filter
+
+logger = logging.getLogger(__name__)
+status_bp = Blueprint('match_status', __name__)
+
+# Status values published to riders
+STATUS_SEARCHING = 'searching'
+STATUS_MATCHED = 'matched'
+STATUS_TIMEOUT = 'timeout'
+STATUS_CANCELLED = 'cancelled'
+STATUS_LEFT = 'left'
+STATUS_MATCH_CANCELLED = 'match_cancelled'
+STATUS_IDLE = 'idle'
+# Statuses after which the rider's request is settled; streams close once one is sent
+TERMINAL_STATUSES = {STATUS_MATCHED, STATUS_TIMEOUT, STATUS_CANCELLED, STATUS_LEFT, STATUS_MATCH_CANCELLED}
+
+# --- In-Process Pub/Sub ---
+class MatchStatusBroker:
+    """Keeps each rider's latest matching status and wakes waiters when it changes.
+
+    State lives in this process only, which is fine while the matcher runs in
+    the web process's scheduler thread. Entries expire after ttl_seconds and the
+    table is capped at max_users (oldest updates evicted first).
+
+    Waiters block on a per-user condition (all sharing one lock), so a publish
+    only wakes the clients of the riders it concerns.
+    """
+
+    def __init__(self, ttl_seconds=3600, max_users=50000):
+        self._lock = threading.Lock()
+        self._states = {}  # user_id -> {'version', 'status', 'data', 'updated_at'}
+        self._waiters = {}  # user_id -> [Condition, number of waiting clients]
+        self._version = 0
+        self.ttl_seconds = ttl_seconds
+        self.max_users = max_users
+
+    def _set(self, user_id, status, data, now):
+        self._version += 1
+        self._states.pop(user_id, None)  # re-insert so dict order tracks recency
+        self._states[user_id] = {'version': self._version, 'status': status, 'data': data, 'updated_at': now}
+        waiter = self._waiters.get(user_id)
+        if waiter is not None:
+            waiter[0].notify_all()
+
+    def publish(self, user_id, status, **data):
+        with self._lock:
+            self._set(user_id, status, data, time.time())
+            self._evict()
+
+    def publish_many(self, user_ids, status, **data):
+        """Same status for many riders under one lock acquisition (e.g. a formed group)."""
+        with self._lock:
+            now = time.time()
+            for user_id in user_ids:
+                self._set(user_id, status, dict(data), now)
+            self._evict()
+
+    def _evict(self):
+        cutoff = time.time() - self.ttl_seconds
+        while self._states:
+            user_id, state = next(iter(self._states.items()))
+            if state['updated_at'] >= cutoff and len(self._states) <= self.max_users:
+                break
+            del self._states[user_id]
+
+    def get(self, user_id):
+        with self._lock:
+            state = self._states.get(user_id)
+            return dict(state) if state else None
+
+    def wait_for_change(self, user_id, since_version, timeout):
+        """Blocks until user_id's state is newer than since_version or timeout elapses."""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            waiter = self._waiters.get(user_id)
+            if waiter is None:
+                waiter = self._waiters[user_id] = [threading.Condition(self._lock), 0]
+            waiter[1] += 1
+            try:
+                while True:
+                    state = self._states.get(user_id)
+                    if state and state['version'] > since_version:
+                        return dict(state)
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return dict(state) if state else None
+                    waiter[0].wait(remaining)
+            finally:
+                waiter[1] -= 1
+                if waiter[1] == 0:
+                    del self._waiters[user_id]
+
+broker = MatchStatusBroker()
+
+# --- Helpers ---
+_token_cache = {}  # access token -> (user_id, expires_at)
+_token_cache_lock = threading.Lock()
+TOKEN_CACHE_SECONDS = 600
+
+def resolve_liff_user():
+    """Maps the LIFF access token in the Authorization header to a LINE user ID.
+
+    Tokens are checked against the LINE profile endpoint once and cached, so
+    polling clients don't cost an API call per request.
+    """
+    auth = request.headers.get('Authorization', '')
+    if not auth.startswith('Bearer '):
+        return None
+    token = auth[len('Bearer '):].strip()
+    now = time.time()
+    with _token_cache_lock:
+        cached = _token_cache.get(token)
+        if cached and cached[1] > now:
+            return cached[0]
+    try:
+        response = requests.get("https://api.line.me/v2/profile", headers={"Authorization": f"Bearer {token}"}, timeout=5)
+        if response.status_code != 200:
+            return None
+        user_id = response.json().get('userId')
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logger.warning(f"Failed to verify LIFF access token: {e}")
+        return None
+    with _token_cache_lock:
+        if len(_token_cache) > 10000:
+            _token_cache.clear()
+        _token_cache[token] = (user_id, now + TOKEN_CACHE_SECONDS)
+    return user_id
+
+def load_initial_status(user_id):
+    """One DB lookup for clients connecting before anything was published for them."""
+    if db is None:
+        return None
+    if db.pending_matches.find_one({'line_user_id': user_id}, {'_id': 1}):
+        broker.publish(user_id, STATUS_SEARCHING)
+    else:
+        match = db.matches.find_one(hot_member_filter(user_id), {'group_id': 1, 'members': 1})
+        if match:
+            broker.publish(user_id, STATUS_MATCHED, group_id=match['group_id'], group_size=len(match.get('members', [])))
+        else:
+            broker.publish(user_id, STATUS_IDLE)
+    return broker.get(user_id)
+
+def _serialize(state):
+    if state is None:
+        return {'version': 0, 'status': STATUS_IDLE, 'data': {}}
+    return {'version': state['version'], 'status': state['status'], 'data': state['data']}
+
+# --- Routes ---
+@status_bp.route("/status/match", methods=['GET'])
+def match_status_long_poll():
+    """Long-poll: returns as soon as the rider's status is newer than ?since=, or after the poll window."""
+    user_id = resolve_liff_user()
+    if not user_id:
+        abort(401)
+    try:
+        since = int(request.args.get('since', 0))
+    except ValueError:
+        abort(400)
+
+    if broker.get(user_id) is None:
+        state = load_initial_status(user_id)
+        if state is not None and state['version'] > since:
+            return jsonify(_serialize(state))
+    timeout = current_app.config['STATUS_LONG_POLL_SECONDS']
+    return jsonify(_serialize(broker.wait_for_change(user_id, since, timeout)))
+
+@status_bp.route("/status/match/stream", methods=['GET'])
+def match_status_stream():
+    """Server-sent events: pushes every status change, with a keep-alive comment each poll window.
+
+    The stream ends after a terminal status or after STATUS_STREAM_MAX_SECONDS,
+    so it never holds a worker indefinitely; EventSource clients reconnect on their own.
+    """
+    user_id = resolve_liff_user()
+    if not user_id:
+        abort(401)
+    timeout = current_app.config['STATUS_LONG_POLL_SECONDS']
+    deadline = time.monotonic() + current_app.config['STATUS_STREAM_MAX_SECONDS']
+    state = broker.get(user_id) or load_initial_status(user_id)
+
+    def generate(state):
+        version = 0
+        if state is not None:
+            version = state['version']
+            yield f"data: {json.dumps(_serialize(state))}\n\n"
+            if state['status'] in TERMINAL_STATUSES:
+                return
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            state = broker.wait_for_change(user_id, version, min(timeout, remaining))
+            if state is None or state['version'] <= version:
+                yield ": keep-alive\n\n"
+                continue
+            version = state['version']
+            yield f"data: {json.dumps(_serialize(state))}\n\n"
+            if state['status'] in TERMINAL_STATUSES:
+                return
+
+    return Response(stream_with_context(generate(state)), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
@@ -1,6 +1,7 @@
 # --- matching_logic.py ---
 import logging
 import uuid
+import random
 import time
 from threading import Thread
 from datetime import datetime, timedelta
@@ -10,29 +11,28 @@ import requests
 # This is simpler but relies on global state.
 from app import db, line_bot_api
 import message_templates # Use the message template functions
+from demand_analytics import DemandRollup
+import match_status
+import route_scoring
+import pending_queue
+import notification_outbox
+import tracing
+from load_shedding import admission
 
 logger = logging.getLogger(__name__)
 
 # --- Helper Functions (Moved Here) ---
-def get_user_profile(user_id):
-     """Attempts to get user's Line display name."""
-     if line_bot_api is None: return None
-     try:
-         profile = line_bot_api.get_profile(user_id)
-         return profile.display_name
-     except Exception as e:
-         logger.warning(f"Failed to get profile for {user_id}: {e}")
-         return None
-
-def notify_match_timeout(user_id, timeout_minutes):
-    """Notifies user about match timeout."""
-    if line_bot_api is None: return
-    try:
-        message = message_templates.create_timeout_message(timeout_minutes)
-        line_bot_api.push_message(user_id, message)
-        logger.info(f"Notified user {user_id} about match timeout.")
-    except Exception as e:
-        logger.error(f"Failed to notify timeout for {user_id}: {e}")
+def notify_match_timeout(user_ids, timeout_minutes):
+    """Queues the match timeout notice for the given users (identical payloads are multicast).
+
+    Returns True only if a row was written for every user.
+    """
+    message = message_templates.create_timeout_message(timeout_minutes)
+    if notification_outbox.enqueue(user_ids, message, 'match_timeout', ref=f"timeout:{uuid.uuid4()}") < len(user_ids):
+        logger.error(f"Failed to queue match timeout notice for {len(user_ids)} users.")
+        return False
+    logger.info(f"Queued match timeout notice for {len(user_ids)} users.")
+    return True
 
 
 def show_loading_indicator(user_id: str, seconds: int = 30):
@@ -68,7 +68,8 @@ def show_loading_indicator(user_id: str, seconds: int = 30):
     }
 
     try:
-        response = requests.post(api_url, headers=headers, json=data, timeout=10) # Added timeout
+        with tracing.span("line.loading_indicator"):
+            response = requests.post(api_url, headers=headers, json=data, timeout=10) # Added timeout
         response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
 
         if response.status_code == 202: # 202 Accepted is success for this API
@@ -85,6 +86,234 @@ def show_loading_indicator(user_id: str, seconds: int = 30):
         if hasattr(e, 'response') and e.response is not None:
              logger.error(f"--> Response status: {e.response.status_code}, body: {e.response.text}")
 
+def flush_demand_rollup(rollup):
+    """Writes this cycle's analytics counters. Never lets analytics break matching."""
+    try:
+        touched = rollup.flush(db)
+        logger.debug(f"[Matcher] Demand rollup updated {touched} buckets.")
+    except Exception as e:
+        logger.error(f"[Matcher] Failed to write demand rollup: {e}")
+
+def resolve_members_info(users_info, pending_docs):
+    """Adds name, phone and party size for the riders in pending_docs to users_info.
+
+    Riders already in users_info are skipped; the rest are loaded with a single
+    projected $in query (unknown users map to {} so they aren't queried again).
+    """
+    user_ids = {p['line_user_id'] for p in pending_docs} - users_info.keys()
+    if not user_ids: return
+    try:
+        cursor = db.users.find(
+            {'line_user_id': {'$in': list(user_ids)}},
+            {'_id': 0, 'line_user_id': 1, 'name': 1, 'phone': 1, 'passengers': 1}
+        )
+        found = {u['line_user_id']: u for u in cursor}
+    except Exception as e:
+        logger.error(f"[Matcher] Failed to resolve member info: {e}")
+        return
+    for uid in user_ids:
+        users_info[uid] = found.get(uid, {})
+
+def build_match_notifications(match_data, group_pending, users_info):
+    """Outbox entries (user_ids, messages, kind) with the leader/member messages for one group."""
+    leader_id = match_data['leader_id']
+    group_size = len(match_data['members'])
+    party_sizes = {p['line_user_id']: p.get('passengers', 1) for p in group_pending}
+
+    def info_for(uid):
+        info = dict(users_info.get(uid, {}))
+        # Party size as submitted with this request takes precedence over the profile value
+        info['passengers'] = party_sizes.get(uid, info.get('passengers'))
+        return {k: v for k, v in info.items() if v is not None}
+
+    leader_info = info_for(leader_id)
+    members_info = [info_for(uid) for uid in match_data['members'] if uid != leader_id]
+    entries = []
+    for uid in match_data['members']:
+        info = info_for(uid)
+        display_name = info.get('name') or "共乘夥伴"
+        try:
+            messages = [message_templates.create_match_success_flex(display_name, group_size, match_data)]
+            if uid == leader_id:
+                messages.append(message_templates.create_leader_match_success(display_name, match_data, members_info))
+            else:
+                messages.append(message_templates.create_member_match_success(display_name, match_data, leader_info))
+            entries.append(([uid], messages, 'match_success'))
+        except Exception as e:
+            logger.error(f"Failed to build match success for {uid}: {e}")
+    return entries
+
+def scored_candidate_order(queue, seed, candidates, doc_index, route_scores, max_dest_distance_m, max_detour_ratio):
+    """The seed, then its compatible partners still in the queue, best first.
+
+    Only the top-k partners are scored; anyone beyond them, or failing the distance
+    or detour threshold, is not offered to this seed.
+    """
+    yield seed
+    for partner in route_scores.ranked_partners(doc_index[id(seed)], max_dest_distance_m, max_detour_ratio):
+        doc = candidates[partner]
+        if doc is not seed and doc in queue:
+            yield doc
+
+def relaxed_candidate_order(relaxed_buckets):
+    """candidate_order for one relaxation step: route-scored when enabled, else queue order.
+
+    Fine cells span only metres, so they keep pure wait-time order; relaxed cells
+    (100 m and up) are where destination distance and detour actually differ.
+    """
+    if not current_app.config['ROUTE_SCORING_ENABLED']:
+        return queue_order
+    candidates = [p for _, users_at_dest in relaxed_buckets for p in users_at_dest]
+    bucket_ids = [b for b, (_, users_at_dest) in enumerate(relaxed_buckets) for _ in users_at_dest]
+    started = time.perf_counter()
+    try:
+        route_scores = route_scoring.score_candidates(
+            candidates, bucket_ids,
+            top_k=current_app.config['ROUTE_SCORE_TOP_K'],
+            chunk_rows=current_app.config['ROUTE_SCORE_CHUNK_ROWS']
+        )
+    except Exception as e:
+        logger.error(f"[Matcher] Route scoring failed, falling back to queue order: {e}")
+        return queue_order
+    if route_scores is None:
+        return queue_order
+    logger.info(f"Scored {len(candidates)} relaxed candidates in {len(relaxed_buckets)} buckets in {(time.perf_counter() - started) * 1000:.1f} ms.")
+    doc_index = {id(p): i for i, p in enumerate(candidates)}
+    max_dest_distance_m = current_app.config['ROUTE_MAX_DEST_DISTANCE_M']
+    max_detour_ratio = current_app.config['ROUTE_MAX_DETOUR_RATIO']
+    return lambda queue, seed: scored_candidate_order(queue, seed, candidates, doc_index, route_scores, max_dest_distance_m, max_detour_ratio)
+
+def queue_order(queue, seed):
+    """The seed, then everyone else in queue (fairness) order."""
+    yield seed
+    for doc in queue:
+        if doc is not seed:
+            yield doc
+
+def bucket_by_destination(docs, precision):
+    """Groups pending docs by destination rounded to `precision` decimal places."""
+    destinations = {}
+    for p in docs:
+        dest_coords = p.get('destination')
+        user_id = p.get('line_user_id')
+        if not dest_coords or len(dest_coords) != 2:
+            logger.warning(f"User {user_id}'s pending request lacks valid destination, skipping.")
+            continue
+        try:
+            lon, lat = float(dest_coords[0]), float(dest_coords[1])
+            dest_key = f"{lon:.{precision}f},{lat:.{precision}f}"
+            if dest_key not in destinations: destinations[dest_key] = []
+            destinations[dest_key].append(p)
+        except (ValueError, TypeError):
+            logger.warning(f"User {user_id}'s destination format error: {dest_coords}, skipping.")
+            continue
+    return destinations
+
+def commit_group(dest_key, group, passengers, rollup, users_info, matched_user_ids):
+    """Saves a formed group as a match and queues its notifications. Returns False if either failed.
+
+    The outbox rows are written right after the match insert, so a crash later in
+    the cycle cannot leave a saved match whose members were never told. If they
+    can't be written (after one retry) the match is deleted again and the riders
+    stay pending.
+    """
+    group_user_ids = [u['line_user_id'] for u in group]
+    logger.info(f"Formed group at {dest_key} ({len(group_user_ids)} users, {passengers} passengers): {group_user_ids}")
+
+    match_id = str(uuid.uuid4())
+    match_data = {
+        'group_id': match_id, 'leader_id': random.choice(group_user_ids),
+        'members': group_user_ids, 'destination_key': dest_key,
+        'destination_coords': group[0]['destination'],
+        'total_passengers': passengers,
+        # The leader is asked for the plate; register_license_plate makes the match active.
+        'status': message_templates.STATE_AWAITING_PLATE, 'created_at': datetime.now()
+    }
+    try:
+        db.matches.insert_one(match_data)
+    except Exception as e:
+        logger.error(f"Failed to save match record {match_id}: {e}")
+        return False
+    entries = build_match_notifications(match_data, group, users_info)
+    queued = notification_outbox.enqueue_many(entries, ref=match_id) or notification_outbox.enqueue_many(entries, ref=match_id)
+    if entries and not queued:
+        logger.error(f"Failed to queue notifications for match {match_id}; rolling it back.")
+        try:
+            db.matches.delete_one({'group_id': match_id})
+        except Exception as e:
+            logger.error(f"Failed to roll back match {match_id}: {e}")
+        return False
+    logger.info(f"Queued {queued} match success notifications for match {match_id}.")
+    matched_user_ids.update(group_user_ids)
+    rollup.record_match(match_data['destination_coords'], group)
+    match_status.broker.publish_many(group_user_ids, match_status.STATUS_MATCHED, group_id=match_id, group_size=len(group_user_ids))
+    return True
+
+def form_groups_in_bucket(dest_key, queue, candidate_order, commit, seed_eligible=None):
+    """Draws groups from a FairPendingQueue until no seed can form one.
+
+    The seed is the highest-priority rider (optionally the highest-priority one
+    passing seed_eligible); candidate_order(queue, seed) yields who to try next.
+    """
+    while len(queue) >= 2:
+        seed = next((d for d in queue if seed_eligible is None or seed_eligible(d)), None)
+        if seed is None: break
+        group, passengers = pending_queue.take_group(candidate_order(queue, seed))
+        if len(group) >= 2:
+            commit(dest_key, group, passengers)
+            queue.remove(group) # removed even if the insert failed, as before
+        else: # Cannot form group
+            logger.debug(f"User {seed['line_user_id']} at {dest_key} could not form group.")
+            queue.remove([seed])
+
+# Fields the matcher actually reads from a pending request
+PENDING_PROJECTION = {'_id': 0, 'line_user_id': 1, 'destination': 1, 'origin': 1, 'passengers': 1, 'timestamp': 1}
+
+def fetch_destination_buckets(precision, batch_size, lone_waited_before=None):
+    """Buckets pending requests by rounded destination inside MongoDB.
+
+    Singleton buckets, and buckets where even the smallest party can't share
+    (min passengers > 2), are dropped server-side, so only riders who can form a
+    group are transferred, with a minimal projection, as a streamed cursor. With
+    lone_waited_before, singletons whose rider has waited since before then are
+    kept too, so radius relaxation can still pair them.
+    Returns {dest_key: [pending docs]} like the in-process grouping.
+    """
+    keep = {'count': {'$gte': 2}, 'min_passengers': {'$lte': 2}}
+    if lone_waited_before is not None:
+        keep = {'$or': [keep, {'count': 1, 'oldest': {'$lt': lone_waited_before}}]}
+    pipeline = [
+        {'$match': {'destination.1': {'$exists': True}}},
+        {'$project': PENDING_PROJECTION},
+        {'$set': {
+            'cell_lon': {'$round': [{'$convert': {'input': {'$arrayElemAt': ['$destination', 0]}, 'to': 'double', 'onError': None, 'onNull': None}}, precision]},
+            'cell_lat': {'$round': [{'$convert': {'input': {'$arrayElemAt': ['$destination', 1]}, 'to': 'double', 'onError': None, 'onNull': None}}, precision]},
+        }},
+        {'$group': {
+            '_id': {'lon': '$cell_lon', 'lat': '$cell_lat'},
+            'riders': {'$push': {
+                'line_user_id': '$line_user_id', 'destination': '$destination', 'origin': '$origin',
+                'passengers': '$passengers', 'timestamp': '$timestamp'
+            }},
+            'count': {'$sum': 1},
+            'total_passengers': {'$sum': {'$ifNull': ['$passengers', 1]}},
+            'min_passengers': {'$min': {'$ifNull': ['$passengers', 1]}},
+            'oldest': {'$min': '$timestamp'},
+        }},
+        {'$match': keep},
+    ]
+    destinations = {}
+    for bucket in db.pending_matches.aggregate(pipeline, batchSize=batch_size, allowDiskUse=True):
+        lon, lat = bucket['_id']['lon'], bucket['_id']['lat']
+        if lon is None or lat is None:
+            logger.warning(f"Skipping {bucket['count']} pending requests with malformed destinations.")
+            continue
+        dest_key = f"{lon:.{precision}f},{lat:.{precision}f}"
+        # $push keeps missing fields as absent, so riders look like regular pending docs
+        destinations.setdefault(dest_key, []).extend(bucket['riders'])
+        logger.debug(f"Bucket {dest_key}: {bucket['count']} riders, {bucket['total_passengers']} passengers.")
+    return destinations
+
 # --- Core Matching Logic ---
 def process_pending_matches():
     """Processes pending matches, run by the scheduler."""
@@ -96,6 +325,7 @@ def process_pending_matches():
     with current_app.app_context():
         timeout_minutes = current_app.config['MATCH_TIMEOUT_MINUTES']
         precision = current_app.config['DESTINATION_PRECISION']
+        rollup = DemandRollup(current_app.config['ANALYTICS_CELL_PRECISION'])
         logger.info("----- Starting Match Processing -----")
 
         # 1. Handle Timeouts
@@ -104,103 +334,83 @@ def process_pending_matches():
         if timed_out_users:
             timed_out_ids = [u['line_user_id'] for u in timed_out_users]
             logger.info(f"Found {len(timed_out_ids)} timed out requests: {timed_out_ids}")
-            if timed_out_ids:
-                db.pending_matches.delete_many({'line_user_id': {'$in': timed_out_ids}})
-            for user in timed_out_users:
-                notify_match_timeout(user['line_user_id'], timeout_minutes)
-
-        # 2. Get remaining pending users
-        pending = list(db.pending_matches.find())
-        if not pending:
-            logger.info("No pending requests to process.")
-            logger.info("----- Match Processing Finished -----")
-            return
-        logger.info(f"Processing {len(pending)} pending requests.")
-
-        # 3. Group by Destination
-        destinations = {}
-        for p in pending:
-            dest_coords = p.get('destination')
-            user_id = p.get('line_user_id')
-            if not dest_coords or len(dest_coords) != 2:
-                logger.warning(f"User {user_id}'s pending request lacks valid destination, skipping.")
-                continue
-            try:
-                lon, lat = float(dest_coords[0]), float(dest_coords[1])
-                dest_key = f"{lon:.{precision}f},{lat:.{precision}f}"
-                if dest_key not in destinations: destinations[dest_key] = []
-                destinations[dest_key].append(p)
-            except (ValueError, TypeError):
-                logger.warning(f"User {user_id}'s destination format error: {dest_coords}, skipping.")
-                continue
-
-        # 4. Process each destination group
+            # Delete only once the notice is queued; otherwise the riders time out again next cycle
+            if notify_match_timeout(timed_out_ids, timeout_minutes):
+                admission.note_pending(-db.pending_matches.delete_many({'line_user_id': {'$in': timed_out_ids}}).deleted_count)
+                for user in timed_out_users:
+                    rollup.record_timeout(user)
+                    match_status.broker.publish(user['line_user_id'], match_status.STATUS_TIMEOUT, timeout_minutes=timeout_minutes)
+
+        cycle_now = datetime.now()
+        relax_after_seconds = current_app.config['MATCH_RELAX_AFTER_MINUTES'] * 60
+        relax_steps = min(current_app.config['MATCH_RELAX_MAX_STEPS'], precision) if relax_after_seconds > 0 else 0
+
+        if current_app.config['MATCH_SERVER_SIDE_GROUPING']:
+            # 2+3. Let MongoDB bucket by destination; only groupable buckets (and lone long waiters) come back
+            lone_waited_before = cycle_now - timedelta(seconds=relax_after_seconds) if relax_steps else None
+            destinations = fetch_destination_buckets(precision, current_app.config['MATCH_AGGREGATION_BATCH_SIZE'], lone_waited_before)
+            if not destinations:
+                flush_demand_rollup(rollup)
+                logger.info("No groupable destination buckets this cycle.")
+                logger.info("----- Match Processing Finished -----")
+                return
+            logger.info(f"Processing {sum(len(v) for v in destinations.values())} pending requests in {len(destinations)} buckets.")
+        else:
+            # 2. Get remaining pending users
+            pending = list(db.pending_matches.find())
+
+            if not pending:
+                flush_demand_rollup(rollup)
+                logger.info("No pending requests to process.")
+                logger.info("----- Match Processing Finished -----")
+                return
+            logger.info(f"Processing {len(pending)} pending requests.")
+
+            # 3. Group by Destination
+            destinations = bucket_by_destination(pending, precision)
+
+        # 4. Process each destination group, oldest (and hardest-to-fit) riders first
         matched_user_ids_in_cycle = set()
+        # Member info for commit_group's messages: one query for the groupable buckets, one per relaxation step
+        users_info = {}
+        resolve_members_info(users_info, [p for users_at_dest in destinations.values() if len(users_at_dest) >= 2 for p in users_at_dest])
+        party_weight = current_app.config['MATCH_PRIORITY_PARTY_WEIGHT_SECONDS']
+        commit = lambda key, group, passengers: commit_group(key, group, passengers, rollup, users_info, matched_user_ids_in_cycle)
+
         for dest_key, users_at_dest in destinations.items():
             if len(users_at_dest) < 2: continue
-
             logger.info(f"Processing destination {dest_key} with {len(users_at_dest)} users.")
-            users_at_dest.sort(key=lambda x: x.get('passengers', 1))
-            remaining_users_at_dest = users_at_dest.copy()
-
-            while len(remaining_users_at_dest) >= 2:
-                # --- Greedy Grouping Logic ---
-                potential_group, current_passengers, indices_in_remaining = [], 0, []
-                for i, user in enumerate(remaining_users_at_dest):
-                    user_passengers = user.get('passengers', 1)
-                    if current_passengers + user_passengers <= 4 and len(potential_group) < 4:
-                        potential_group.append(user)
-                        current_passengers += user_passengers
-                        indices_in_remaining.append(i)
-                        if len(potential_group) == 4: break
-                    elif len(potential_group) < 4 and current_passengers + user_passengers > 4: continue
-
-                # --- Check if group formed ---
-                if len(potential_group) >= 2:
-                    group_user_ids = [u['line_user_id'] for u in potential_group]
-                    logger.info(f"Formed group at {dest_key} ({len(group_user_ids)} users, {current_passengers} passengers): {group_user_ids}")
-
-                    match_id = str(uuid.uuid4())
-                    match_data = {
-                        'group_id': match_id, 'leader_id': group_user_ids[0],
-                        'members': group_user_ids, 'destination_key': dest_key,
-                        'destination_coords': potential_group[0]['destination'],
-                        'total_passengers': current_passengers,
-                        'status': message_templates.MATCH_STATUS_ACTIVE, 'created_at': datetime.now()
-                    }
-                    try:
-                        db.matches.insert_one(match_data)
-                        matched_user_ids_in_cycle.update(group_user_ids)
-                    except Exception as e:
-                        logger.error(f"Failed to save match record {match_id}: {e}")
-                        temp_remaining = [user for i, user in enumerate(remaining_users_at_dest) if i not in indices_in_remaining]
-                        remaining_users_at_dest = temp_remaining
-                        continue
-
-                    # Notify users
-                    if line_bot_api:
-                        for user_pending_data in potential_group:
-                            uid = user_pending_data['line_user_id']
-                            profile_name = get_user_profile(uid) or "共乘夥伴"
-                            try:
-                                message = message_templates.create_match_success_flex(profile_name, len(group_user_ids), match_data)
-                                line_bot_api.push_message(uid, message)
-                            except Exception as e:
-                                logger.error(f"Failed to send match success to {uid}: {e}")
-
-                    # Remove matched users from remaining list
-                    temp_remaining = [user for i, user in enumerate(remaining_users_at_dest) if i not in indices_in_remaining]
-                    remaining_users_at_dest = temp_remaining
-
-                else: # Cannot form group
-                    if remaining_users_at_dest:
-                        logger.debug(f"User {remaining_users_at_dest[0]['line_user_id']} at {dest_key} could not form group.")
-                        remaining_users_at_dest.pop(0)
-                    else: break
+            queue = pending_queue.FairPendingQueue(users_at_dest, cycle_now, party_weight)
+            form_groups_in_bucket(dest_key, queue, queue_order, commit)
+
+        # 4b. Relax the match radius for long waiters: leftovers are re-bucketed one
+        # decimal place coarser per MATCH_RELAX_AFTER_MINUTES waited, and a relaxed
+        # group must be seeded by someone who has waited that long.
+        for step in range(1, relax_steps + 1):
+            coarse_precision = precision - step
+            min_wait = step * relax_after_seconds
+            leftovers = [p for users_at_dest in destinations.values() for p in users_at_dest if p['line_user_id'] not in matched_user_ids_in_cycle]
+            is_long_waiter = lambda doc, min_wait=min_wait: bool(doc.get('timestamp')) and (cycle_now - doc['timestamp']).total_seconds() >= min_wait
+            if not any(is_long_waiter(p) for p in leftovers): break
+
+            relaxed_buckets = [
+                (dest_key, users_at_dest) for dest_key, users_at_dest in bucket_by_destination(leftovers, coarse_precision).items()
+                if len(users_at_dest) >= 2 and any(is_long_waiter(p) for p in users_at_dest)
+            ]
+            resolve_members_info(users_info, [p for _, users_at_dest in relaxed_buckets for p in users_at_dest])
+            candidate_order = relaxed_candidate_order(relaxed_buckets)
+            for dest_key, users_at_dest in relaxed_buckets:
+                logger.info(f"Relaxed matching (precision {coarse_precision}) at {dest_key} with {len(users_at_dest)} users.")
+                queue = pending_queue.FairPendingQueue(users_at_dest, cycle_now, party_weight)
+                form_groups_in_bucket(dest_key, queue, candidate_order, commit, seed_eligible=is_long_waiter)
 
         # 5. Remove matched users from pending collection
         if matched_user_ids_in_cycle:
             deleted_count = db.pending_matches.delete_many({'line_user_id': {'$in': list(matched_user_ids_in_cycle)}}).deleted_count
+            admission.note_pending(-deleted_count)
             logger.info(f"Removed {deleted_count} matched users from pending collection.")
 
+        # 6. Persist this cycle's demand rollup
+        flush_demand_rollup(rollup)
+
         logger.info("----- Match Processing Finished -----")
\ No newline at end of file
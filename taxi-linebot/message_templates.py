@@ -16,6 +16,8 @@ STATE_AWAITING_PLATE = 'awaiting_plate'  # 新增此行
 
 MATCH_STATUS_ACTIVE = 'active'
 MATCH_STATUS_CANCELLED = 'cancelled'
+MATCH_STATUS_COMPLETED = 'completed'
+MATCH_STATUS_EXPIRED = 'expired'
 
 # --- Template Generation Functions ---
 
@@ -68,6 +70,7 @@ def create_help():
 
 💡 **小提示**：
 - 目的地越精確，找到的夥伴可能越少，但也越順路。
+- 配對前分享您的「上車地點」，系統會優先安排順路的夥伴。
 - 配對可能需要幾分鐘，請耐心等候。
 - 如果長時間未配對成功，可能是附近暫無合適夥伴，可稍後再試。
 
@@ -89,6 +92,9 @@ def create_ask_for_destination():
         )
     )
 
+def create_pickup_saved():
+    return TextSendMessage(text="📍 已記錄您的上車地點，配對時會優先安排順路的夥伴。\n\n如果您想設定目的地，請先點選主選單的 '設定目的地' 按鈕。")
+
 def create_ask_for_passengers(address: str):
     return [
         TextSendMessage(text=f"📍 已設定目的地：\n{address}"),
@@ -111,37 +117,41 @@ def create_settings_complete(address: str, passengers: int):
         )
     ]
 
-def create_searching_flex(interval_minutes: int):
-     return FlexSendMessage(
-         alt_text='📬 正在為您尋找共乘夥伴...',
-         contents={ # 保持原來的 Flex 結構
-             "type": "bubble",
-             "body": {
-                 "type": "box", "layout": "vertical",
-                 "contents": [
-                     {"type": "text", "text": "📬 正在為您尋找共乘夥伴...", "weight": "bold", "size": "md", "wrap": True},
-                     {"type": "text", "text": f"⏳ 請稍候，系統每 {interval_minutes} 分鐘進行一次配對...", "size": "sm", "color": "#999999", "margin": "md", "wrap": True},
-                     {"type": "box", "layout": "horizontal", "margin": "lg",
-                      "contents": [
-                          {"type": "text", "text": "🚗💨", "flex": 0, "margin": "sm"},
-                          {"type": "box", "layout": "vertical", "flex": 1, "contents": [
-                              {"type": "filler"},
-                              {"type": "box", "layout": "vertical", "height": "6px", "backgroundColor": "#DEE2E6", "cornerRadius": "sm", "contents": [
-                                  {"type": "box", "layout": "horizontal", "height": "100%", "width": "30%", "backgroundColor": "#0D6EFD", "cornerRadius": "sm"}
-                              ]},
-                              {"type": "filler"}
-                          ]}
+def create_searching_flex(interval_minutes: int, status_url: str = None):
+     bubble = { # 保持原來的 Flex 結構
+         "type": "bubble",
+         "body": {
+             "type": "box", "layout": "vertical",
+             "contents": [
+                 {"type": "text", "text": "📬 正在為您尋找共乘夥伴...", "weight": "bold", "size": "md", "wrap": True},
+                 {"type": "text", "text": f"⏳ 請稍候，系統每 {interval_minutes} 分鐘進行一次配對...", "size": "sm", "color": "#999999", "margin": "md", "wrap": True},
+                 {"type": "box", "layout": "horizontal", "margin": "lg",
+                  "contents": [
+                      {"type": "text", "text": "🚗💨", "flex": 0, "margin": "sm"},
+                      {"type": "box", "layout": "vertical", "flex": 1, "contents": [
+                          {"type": "filler"},
+                          {"type": "box", "layout": "vertical", "height": "6px", "backgroundColor": "#DEE2E6", "cornerRadius": "sm", "contents": [
+                              {"type": "box", "layout": "horizontal", "height": "100%", "width": "30%", "backgroundColor": "#0D6EFD", "cornerRadius": "sm"}
+                          ]},
+                          {"type": "filler"}
                       ]}
-                 ]
-             },
-             "footer": {
-                 "type": "box", "layout": "vertical", "contents": [{
-                     "type": "button", "style": "secondary", "height": "sm",
-                     "action": {"type": "postback", "label": "😫 取消搜尋", "data": "action=cancel_pending_match"}
-                 }]
-             }
+                  ]}
+             ]
+         },
+         "footer": {
+             "type": "box", "layout": "vertical", "contents": [{
+                 "type": "button", "style": "secondary", "height": "sm",
+                 "action": {"type": "postback", "label": "😫 取消搜尋", "data": "action=cancel_pending_match"}
+             }]
          }
-     )
+     }
+     if status_url:
+         # LIFF 即時配對狀態頁，避免額外推播
+         bubble["footer"]["contents"].insert(0, {
+             "type": "button", "style": "primary", "height": "sm",
+             "action": {"type": "uri", "label": "👀 查看即時配對狀態", "uri": status_url}
+         })
+     return FlexSendMessage(alt_text='📬 正在為您尋找共乘夥伴...', contents=bubble)
 
 def create_match_success_flex(profile_name: str, group_size: int, match_data: dict):
     match_id = match_data['group_id']
@@ -197,6 +207,10 @@ def create_match_cancelled_message(match_id: str):
 def create_member_left_message(match_id: str, leaver_name: str, remaining_count: int):
      return TextSendMessage(text=f"ℹ️ 通知：共乘夥伴「{leaver_name}」已退出隊伍 (ID: {match_id[:8]})。目前隊伍尚有 {remaining_count} 人。")
 
+def create_new_leader_message(match_id: str):
+     """Sent to the member who takes over when the leader leaves before giving a plate."""
+     return TextSendMessage(text=f"👑 原隊長已退出，您已成為共乘隊伍 (ID: {match_id[:8]}) 的新隊長。\n\n叫到車後，請直接輸入車牌號碼 (例如 ABC-1234)，我們會通知所有隊員。")
+
 # 在檔案末尾加入新的模板函數
 def create_leader_match_success(leader_name: str, match_data: dict, members_info: list):
     """Message sent to the leader."""
@@ -205,8 +219,11 @@ def create_leader_match_success(leader_name: str, match_data: dict, members_info
     
     for member in members_info:
         phone_display = member.get('phone', '未提供')
-        base_text += f"\n- {member.get('name', '未知夥伴')} (電話: {phone_display})"
+        passengers = member.get('passengers')
+        passengers_display = f", {passengers} 人" if passengers else ""
+        base_text += f"\n- {member.get('name', '未知夥伴')} (電話: {phone_display}{passengers_display})"
 
+    base_text += "\n\n🚕 叫到車後，請直接輸入車牌號碼 (例如 ABC-1234)，我們會通知所有隊員。"
     return TextSendMessage(text=base_text)
 
 def create_member_match_success(member_name: str, match_data: dict, leader_info: dict):
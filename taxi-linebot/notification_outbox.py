@@ -0,0 +1,184 @@
+import hashlib
+import json
+import logging
+import uuid
+from datetime import datetime, timedelta
+from flask import current_app
+from pymongo import InsertOne
+from linebot.models import TextSendMessage, TemplateSendMessage, FlexSendMessage
+from app import db, line_bot_api
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_STATUS_PENDING = 'pending'
+OUTBOX_STATUS_SENDING = 'sending'
+OUTBOX_STATUS_DELIVERED = 'delivered'
+OUTBOX_STATUS_FAILED = 'failed'
+
+MULTICAST_MAX_RECIPIENTS = 500 # LINE multicast limit
+MESSAGE_TYPES = {'text': TextSendMessage, 'template': TemplateSendMessage, 'flex': FlexSendMessage}
+
+# --- Serialization ---
+def _serialize_messages(messages):
+    if not isinstance(messages, (list, tuple)):
+        messages = [messages]
+    return [m.as_json_dict() if hasattr(m, 'as_json_dict') else m for m in messages]
+
+def _deserialize_messages(payload):
+    return [MESSAGE_TYPES[m['type']].new_from_json_dict(m) for m in payload]
+
+def _payload_hash(payload):
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+# --- Enqueue ---
+def outbox_insert_ops(user_ids, messages, kind, ref=None):
+    """InsertOne ops for one outbox row per recipient, for callers that batch their own writes.
+
+    Rows with identical payloads share a payload_hash, which the sender uses to
+    coalesce them into multicast calls. ref tags the rows (e.g. with a match id)
+    so they can be discarded together.
+    """
+    payload = _serialize_messages(messages)
+    payload_hash = _payload_hash(payload)
+    now = datetime.now()
+    row = {
+        'messages': payload, 'payload_hash': payload_hash, 'kind': kind,
+        'status': OUTBOX_STATUS_PENDING, 'attempts': 0,
+        'created_at': now, 'next_attempt_at': now
+    }
+    if ref is not None:
+        row['ref'] = ref
+    return [InsertOne(dict(row, to=uid)) for uid in user_ids]
+
+def enqueue(user_ids, messages, kind, ref=None):
+    """Queues messages for the given users. Returns the number of rows written (all-or-nothing with a ref)."""
+    if db is None: return 0
+    if isinstance(user_ids, str):
+        user_ids = [user_ids]
+    ops = outbox_insert_ops(user_ids, messages, kind, ref)
+    if not ops: return 0
+    try:
+        return db.notification_outbox.bulk_write(ops, ordered=False).inserted_count
+    except Exception as e:
+        logger.error(f"[Outbox] Failed to enqueue '{kind}' for {list(user_ids)}: {e}")
+        if ref is not None:
+            discard(ref)
+        return 0
+
+def enqueue_many(entries, ref=None):
+    """Queues several (user_ids, messages, kind) entries in a single bulk write.
+
+    With a ref the write is all-or-nothing: rows that made it in before a
+    failure are discarded again, so the caller can safely retry or roll back.
+    """
+    if db is None: return 0
+    ops = [op for user_ids, messages, kind in entries for op in outbox_insert_ops(user_ids, messages, kind, ref)]
+    if not ops: return 0
+    try:
+        return db.notification_outbox.bulk_write(ops, ordered=False).inserted_count
+    except Exception as e:
+        logger.error(f"[Outbox] Failed to enqueue {len(ops)} notifications: {e}")
+        if ref is not None:
+            discard(ref)
+        return 0
+
+def discard(ref):
+    """Deletes not-yet-sent rows tagged with ref. Returns the number removed."""
+    try:
+        return db.notification_outbox.delete_many({'ref': ref, 'status': OUTBOX_STATUS_PENDING}).deleted_count
+    except Exception as e:
+        logger.error(f"[Outbox] Failed to discard notifications for {ref}: {e}")
+        return 0
+
+def ensure_outbox_indexes(db_instance, logger, retention_hours):
+    if db_instance is None: return
+    try:
+        db_instance.notification_outbox.create_index([("status", 1), ("next_attempt_at", 1)], background=True)
+        db_instance.notification_outbox.create_index([("claim_id", 1)], background=True)
+        db_instance.notification_outbox.create_index([("ref", 1)], sparse=True, background=True)
+        # Delivered rows are only kept for troubleshooting
+        db_instance.notification_outbox.create_index(
+            [("delivered_at", 1)], expireAfterSeconds=retention_hours * 3600, background=True
+        )
+        logger.info("Ensured indexes on 'notification_outbox'.")
+    except Exception as e:
+        logger.error(f"Error creating notification_outbox indexes: {e}")
+
+# --- Sender Worker ---
+def claim_batch(batch_size, lease_seconds):
+    """Claims up to batch_size due rows for this worker. Rows stuck in 'sending' past the lease are reclaimed."""
+    now = datetime.now()
+    due = {'$or': [
+        {'status': OUTBOX_STATUS_PENDING, 'next_attempt_at': {'$lte': now}},
+        {'status': OUTBOX_STATUS_SENDING, 'claimed_at': {'$lt': now - timedelta(seconds=lease_seconds)}},
+    ]}
+    ids = [d['_id'] for d in db.notification_outbox.find(due, {'_id': 1}).sort('next_attempt_at', 1).limit(batch_size)]
+    if not ids:
+        return []
+    claim_id = str(uuid.uuid4())
+    # Re-checking the due condition makes the claim atomic per row against other workers
+    db.notification_outbox.update_many(
+        {'_id': {'$in': ids}, **due},
+        {'$set': {'status': OUTBOX_STATUS_SENDING, 'claim_id': claim_id, 'claimed_at': now}, '$inc': {'attempts': 1}}
+    )
+    return list(db.notification_outbox.find({'claim_id': claim_id}))
+
+def _send_group(recipients, payload):
+    messages = _deserialize_messages(payload)
+    if len(recipients) == 1:
+        line_bot_api.push_message(recipients[0], messages)
+    else:
+        line_bot_api.multicast(recipients, messages)
+
+def _mark_failed(rows, error, max_attempts, retry_seconds):
+    now = datetime.now()
+    for row in rows:
+        if row.get('attempts', 1) >= max_attempts:
+            update = {'status': OUTBOX_STATUS_FAILED, 'last_error': str(error), 'failed_at': now}
+        else:
+            backoff = retry_seconds * (2 ** (row.get('attempts', 1) - 1))
+            update = {'status': OUTBOX_STATUS_PENDING, 'last_error': str(error), 'next_attempt_at': now + timedelta(seconds=backoff)}
+        db.notification_outbox.update_one({'_id': row['_id'], 'claim_id': row['claim_id']}, {'$set': update, '$unset': {'claim_id': ''}})
+
+def process_outbox():
+    """Sends claimed outbox rows, coalescing identical payloads into multicast calls. Run by the scheduler."""
+    if db is None or line_bot_api is None:
+        logger.error("[Outbox] DB or Line API not available, skipping delivery.")
+        return
+
+    with current_app.app_context():
+        batch_size = current_app.config['OUTBOX_BATCH_SIZE']
+        lease_seconds = current_app.config['OUTBOX_LEASE_SECONDS']
+        max_attempts = current_app.config['OUTBOX_MAX_ATTEMPTS']
+        retry_seconds = current_app.config['OUTBOX_RETRY_SECONDS']
+
+        while True:
+            rows = claim_batch(batch_size, lease_seconds)
+            if not rows:
+                return
+
+            groups = {}
+            for row in rows:
+                groups.setdefault(row['payload_hash'], []).append(row)
+
+            delivered, failed = 0, 0
+            for payload_hash, group_rows in groups.items():
+                payload = group_rows[0]['messages']
+                for i in range(0, len(group_rows), MULTICAST_MAX_RECIPIENTS):
+                    chunk = group_rows[i:i + MULTICAST_MAX_RECIPIENTS]
+                    recipients = list(dict.fromkeys(r['to'] for r in chunk))
+                    try:
+                        _send_group(recipients, payload)
+                    except Exception as e:
+                        logger.error(f"[Outbox] Failed to deliver {len(chunk)} '{chunk[0].get('kind')}' notifications: {e}")
+                        _mark_failed(chunk, e, max_attempts, retry_seconds)
+                        failed += len(chunk)
+                        continue
+                    db.notification_outbox.update_many(
+                        {'_id': {'$in': [r['_id'] for r in chunk]}, 'claim_id': chunk[0]['claim_id']},
+                        {'$set': {'status': OUTBOX_STATUS_DELIVERED, 'delivered_at': datetime.now()}, '$unset': {'claim_id': ''}}
+                    )
+                    delivered += len(chunk)
+            logger.info(f"[Outbox] Delivered {delivered} notifications in {len(groups)} payload groups ({failed} failed).")
+            if len(rows) < batch_size:
+                return
@@ -0,0 +1,71 @@
+from datetime import datetime
+
+MAX_GROUP_MEMBERS = 4
+MAX_GROUP_PASSENGERS = 4
+
+# --- Fair Priority Queue ---
+class FairPendingQueue:
+    """Pending requests of one bucket, ordered by wait time plus party-size fit.
+
+    priority = seconds waited + party_weight_seconds * (passengers - 1)
+
+    Older requests come first so nobody starves behind newer arrivals, and larger
+    parties (which fit in fewer groups) get a head start. Priorities are fixed
+    for the cycle, so the order is computed once; removal is lazy (an id set plus
+    an advancing head), which keeps each draw O(1) amortised.
+    """
+
+    def __init__(self, docs, now=None, party_weight_seconds=60):
+        self.now = now or datetime.now()
+        self.party_weight_seconds = party_weight_seconds
+        self._order = sorted(docs, key=self.priority, reverse=True)
+        self._ids = {id(d) for d in self._order}
+        self._removed = set()
+        self._head = 0
+        self._alive = len(self._order)
+
+    def wait_seconds(self, doc):
+        ts = doc.get('timestamp')
+        return max((self.now - ts).total_seconds(), 0) if ts else 0
+
+    def priority(self, doc):
+        return self.wait_seconds(doc) + self.party_weight_seconds * (doc.get('passengers', 1) - 1)
+
+    def __len__(self):
+        return self._alive
+
+    def __iter__(self):
+        """Remaining requests, highest priority first."""
+        for i in range(self._head, len(self._order)):
+            doc = self._order[i]
+            if id(doc) not in self._removed:
+                yield doc
+
+    def __contains__(self, doc):
+        return id(doc) in self._ids and id(doc) not in self._removed
+
+    def head(self):
+        return next(iter(self), None)
+
+    def remove(self, docs):
+        for doc in docs:
+            if id(doc) in self._ids and id(doc) not in self._removed:
+                self._removed.add(id(doc))
+                self._alive -= 1
+        while self._head < len(self._order) and id(self._order[self._head]) in self._removed:
+            self._head += 1
+
+# --- Group Formation ---
+def take_group(candidates):
+    """Greedy fill from candidates (seed first): up to 4 riders and 4 passengers.
+
+    Returns (group, passengers); the group may have fewer than 2 riders if nobody fits.
+    """
+    group, passengers = [], 0
+    for doc in candidates:
+        doc_passengers = doc.get('passengers', 1)
+        if passengers + doc_passengers <= MAX_GROUP_PASSENGERS:
+            group.append(doc)
+            passengers += doc_passengers
+            if len(group) == MAX_GROUP_MEMBERS or passengers == MAX_GROUP_PASSENGERS: break
+    return group, passengers
@@ -0,0 +1,263 @@
+import argparse
+import logging
+import math
+import random
+import time
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_M = 6371008.8
+
+# --- Coordinate Loading ---
+def _coords_array(docs, field):
+    """Packs [lon, lat] pairs from docs into a contiguous (n, 2) float64 array; NaN where missing."""
+    missing = (np.nan, np.nan)
+    pairs = []
+    for doc in docs:
+        coords = doc.get(field)
+        pair = missing
+        if coords and len(coords) == 2:
+            try:
+                pair = (float(coords[0]), float(coords[1]))
+            except (ValueError, TypeError):
+                pass
+        pairs.append(pair)
+    return np.array(pairs, dtype=np.float64).reshape(len(docs), 2)
+
+def _unit_vectors(lonlat):
+    """Lon/lat degrees -> 3D unit vectors, so great-circle closeness becomes a dot product."""
+    lon = np.radians(lonlat[:, 0])
+    lat = np.radians(lonlat[:, 1])
+    cos_lat = np.cos(lat)
+    return np.ascontiguousarray(np.stack([cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)], axis=1))
+
+def arc_m(u, v):
+    """Element-wise great-circle distance in metres between (n, 3) unit vectors u and v.
+
+    Same result as haversine, but from the chord |u - v|, which has no cancellation
+    at short range and reuses the vectors already built for scoring.
+    """
+    chord = np.sqrt(np.einsum('ij,ij->i', u - v, u - v))
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.minimum(chord / 2, 1.0))
+
+def _headings(origins, dests):
+    """Unit trip direction vectors in a local east/north plane; zero where origin is unknown."""
+    mean_lat = np.radians(np.nanmean(dests[:, 1])) if len(dests) else 0.0
+    east = (dests[:, 0] - origins[:, 0]) * np.cos(mean_lat)
+    north = dests[:, 1] - origins[:, 1]
+    vec = np.stack([east, north], axis=1)
+    norm = np.linalg.norm(vec, axis=1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        vec = np.where(norm > 0, vec / norm, 0.0)
+    return np.nan_to_num(vec)
+
+# --- Pairwise Scoring ---
+class RouteScores:
+    """Top-k most compatible partners for each candidate.
+
+    Only riders in the same destination bucket are compared: with bucket-sorted
+    input the score matrix is block-diagonal, and each chunk of chunk_rows rows
+    is multiplied against just the columns its buckets span. Pair closeness uses
+    a matrix product of unit vectors (chord distance), and exact great-circle
+    distances and detours are only evaluated for the kept top-k pairs.
+    """
+
+    def __init__(self, neighbors, scores, dest_distance_m, detour_ratio, has_origin):
+        self.neighbors = neighbors              # (n, k) candidate indices, best first; -1 = none
+        self.scores = scores                    # (n, k) combined score
+        self.dest_distance_m = dest_distance_m  # (n, k) haversine distance between destinations
+        self.detour_ratio = detour_ratio        # (n, k) extra distance for row rider when sharing
+        self.has_origin = has_origin            # (n,) whether detour could be estimated for the rider
+
+    def ranked_partners(self, i, max_dest_distance_m, max_detour_ratio):
+        """Partner indices for candidate i that pass the thresholds, best first."""
+        keep = (
+            (self.neighbors[i] >= 0)
+            & (self.dest_distance_m[i] <= max_dest_distance_m)
+            & (self.detour_ratio[i] <= max_detour_ratio)
+        )
+        return self.neighbors[i][keep].tolist()
+
+def _bucket_spans(bucket_ids, n):
+    """For each row, the [lo, hi) index range of its bucket. Equal ids must be contiguous."""
+    if bucket_ids is None:
+        return np.zeros(n, dtype=np.int64), np.full(n, n, dtype=np.int64)
+    ids = np.asarray(bucket_ids)
+    bounds = np.flatnonzero(ids[1:] != ids[:-1]) + 1
+    starts = np.concatenate([[0], bounds])
+    ends = np.concatenate([bounds, [n]])
+    sizes = ends - starts
+    return np.repeat(starts, sizes), np.repeat(ends, sizes)
+
+def _row_chunks(row_lo, n, chunk_rows):
+    """Row ranges of about chunk_rows that end on bucket boundaries unless one bucket alone is bigger."""
+    start = 0
+    while start < n:
+        stop = min(start + chunk_rows, n)
+        if stop < n and row_lo[stop] > start:
+            stop = row_lo[stop]
+        yield start, stop
+        start = stop
+
+def score_candidates(docs, bucket_ids=None, top_k=16, chunk_rows=64, distance_scale_m=500.0, heading_weight=1.0):
+    """Scores pairs of pending docs in one vectorised pass and keeps the top_k per rider.
+
+    bucket_ids (one per doc, equal ids contiguous) restricts pairs to the same
+    bucket; without it every pair is scored. Uses 'destination' and, when
+    present, 'origin' ([lon, lat]). Without origins, heading and detour terms
+    are zero and only destination proximity counts. Returns None if there are
+    fewer than two candidates.
+    """
+    n = len(docs)
+    if n < 2:
+        return None
+    row_lo, row_hi = _bucket_spans(bucket_ids, n)
+    dests = _coords_array(docs, 'destination')
+    origins = _coords_array(docs, 'origin')
+    valid = ~np.isnan(dests).any(axis=1)
+    has_origin = ~np.isnan(origins).any(axis=1) & valid
+
+    # float64: at city scale 2 - 2*dot underflows float32 precision
+    dest_vec = _unit_vectors(np.where(valid[:, None], dests, 0.0))
+    heading = _headings(np.where(has_origin[:, None], origins, dests), dests).astype(np.float32)
+    k = min(top_k, n - 1)
+
+    neighbors = np.full((n, k), -1, dtype=np.int64)
+    scores = np.full((n, k), -np.inf, dtype=np.float32)
+    any_origin = has_origin.any()
+    for start, stop in _row_chunks(row_lo, n, chunk_rows):
+        # Columns spanned by the buckets of these rows; everything else is never a partner
+        col_lo, col_hi = row_lo[start], row_hi[stop - 1]
+        # chord length between unit vectors ~ great-circle distance at city scale
+        dot = dest_vec[start:stop] @ dest_vec[col_lo:col_hi].T
+        chord_m = np.sqrt(np.maximum(2.0 - 2.0 * dot, 0.0)) * EARTH_RADIUS_M
+        block = -chord_m / distance_scale_m
+        if any_origin:
+            block += heading_weight * (heading[start:stop] @ heading[col_lo:col_hi].T)
+        if row_lo[start] != row_lo[stop - 1]:
+            # Several small buckets share this chunk; mask the pairs between them
+            cols = np.arange(col_lo, col_hi)
+            block[(cols < row_lo[start:stop, None]) | (cols >= row_hi[start:stop, None])] = -np.inf
+        block[:, ~valid[col_lo:col_hi]] = -np.inf
+        block[~valid[start:stop], :] = -np.inf
+        rows = np.arange(stop - start)
+        block[rows, rows + start - col_lo] = -np.inf  # no self-pairs
+
+        width = col_hi - col_lo
+        kk = min(k, width)
+        if kk < width:
+            top = np.argpartition(block, width - kk, axis=1)[:, width - kk:]
+        else:
+            top = np.broadcast_to(np.arange(width), block.shape)
+        top_scores = np.take_along_axis(block, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        neighbors[start:stop, :kk] = np.take_along_axis(top, order, axis=1) + col_lo
+        scores[start:stop, :kk] = np.take_along_axis(top_scores, order, axis=1)
+    neighbors[~np.isfinite(scores)] = -1
+
+    # Exact metrics for the kept pairs only; empty slots (small buckets) stay at inf / 0
+    rows = np.repeat(np.arange(n), k)
+    cols = neighbors.reshape(-1)
+    kept = np.flatnonzero(cols >= 0)
+    r, c = rows[kept], cols[kept]
+    dest_distance = np.full(n * k, np.inf)
+    dest_distance[kept] = arc_m(dest_vec[r], dest_vec[c])
+    detour = np.zeros(n * k, dtype=np.float64)
+    both = has_origin[r] & has_origin[c]
+    if both.any():
+        # Rider i's trip if partner j is picked up on the way: o_i -> o_j -> d_i
+        r, c = r[both], c[both]
+        origin_vec = _unit_vectors(np.where(has_origin[:, None], origins, dests))
+        direct = np.maximum(arc_m(origin_vec, dest_vec), 1.0)
+        shared = arc_m(origin_vec[r], origin_vec[c]) + arc_m(origin_vec[c], dest_vec[r])
+        detour[kept[both]] = shared / direct[r] - 1.0
+    dest_distance = dest_distance.reshape(n, k)
+    return RouteScores(neighbors, scores, dest_distance, detour.reshape(n, k), has_origin)
+
+# --- Benchmark / Reference Check ---
+def _haversine_m(a, b):
+    lon1, lat1, lon2, lat2 = map(math.radians, (a[0], a[1], b[0], b[1]))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(h))
+
+def synthetic_candidates(n, buckets, origins=True, spread_deg=0.005, seed=1):
+    """Bucket-sorted pending docs around Taipei, for the benchmark and reference check."""
+    rng = random.Random(seed)
+    centers = [(121.45 + rng.random() * 0.2, 25.0 + rng.random() * 0.1) for _ in range(buckets)]
+    docs, bucket_ids = [], []
+    for i in range(n):
+        b = i * buckets // n
+        lon, lat = centers[b]
+        doc = {'destination': [lon + rng.uniform(-spread_deg, spread_deg), lat + rng.uniform(-spread_deg, spread_deg)]}
+        if origins and rng.random() < 0.8:
+            doc['origin'] = [121.45 + rng.random() * 0.2, 25.0 + rng.random() * 0.1]
+        docs.append(doc)
+        bucket_ids.append(b)
+    return docs, bucket_ids
+
+def check_against_reference(docs, bucket_ids, top_k=16, chunk_rows=64, tolerance_m=0.05):
+    """Compares score_candidates with a per-pair pure-Python pass; returns a list of mismatches."""
+    result = score_candidates(docs, bucket_ids, top_k=top_k, chunk_rows=chunk_rows)
+    errors = []
+    for i, doc in enumerate(docs):
+        mates = [j for j in range(len(docs)) if j != i and bucket_ids[j] == bucket_ids[i]]
+        partners = [j for j in result.neighbors[i].tolist() if j >= 0]
+        if len(partners) != min(top_k, len(mates)):
+            errors.append(f"row {i}: {len(partners)} partners, expected {min(top_k, len(mates))}")
+        if any(j not in mates for j in partners):
+            errors.append(f"row {i}: partner outside its bucket")
+            continue
+        for slot, j in enumerate(partners):
+            expected = _haversine_m(doc['destination'], docs[j]['destination'])
+            if abs(result.dest_distance_m[i][slot] - expected) > tolerance_m:
+                errors.append(f"row {i}: distance to {j} is {result.dest_distance_m[i][slot]:.3f} m, expected {expected:.3f} m")
+            if doc.get('origin') and docs[j].get('origin'):
+                direct = max(_haversine_m(doc['origin'], doc['destination']), 1.0)
+                shared = _haversine_m(doc['origin'], docs[j]['origin']) + _haversine_m(docs[j]['origin'], doc['destination'])
+                if abs(result.detour_ratio[i][slot] - (shared / direct - 1.0)) > 1e-4:
+                    errors.append(f"row {i}: detour via {j} differs from reference")
+        if not any('origin' in docs[j] for j in mates + [i]) and partners:
+            nearest = sorted(_haversine_m(doc['destination'], docs[j]['destination']) for j in mates)[:len(partners)]
+            if abs(nearest[-1] - max(result.dest_distance_m[i][:len(partners)])) > tolerance_m:
+                errors.append(f"row {i}: kept partners are not the {len(partners)} nearest")
+    return errors
+
+def benchmark(n, buckets, origins=True, repeat=5, top_k=16, chunk_rows=64):
+    """Median wall time in ms of score_candidates over synthetic bucket-sorted docs."""
+    docs, bucket_ids = synthetic_candidates(n, buckets, origins)
+    score_candidates(docs, bucket_ids, top_k=top_k, chunk_rows=chunk_rows)  # warm-up
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        score_candidates(docs, bucket_ids, top_k=top_k, chunk_rows=chunk_rows)
+        timings.append((time.perf_counter() - started) * 1000)
+    return sorted(timings)[len(timings) // 2]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark score_candidates and check it against a pure-Python reference.")
+    parser.add_argument('--n', type=int, default=5000)
+    parser.add_argument('--buckets', type=int, nargs='+', default=[1000, 100, 10])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top-k', type=int, default=16)
+    parser.add_argument('--chunk-rows', type=int, default=64)
+    parser.add_argument('--check', action='store_true', help="also run the reference check (small inputs)")
+    args = parser.parse_args()
+
+    if args.check:
+        failed = False
+        for buckets, origins in ((40, False), (40, True), (300, True), (1, True)):
+            docs, bucket_ids = synthetic_candidates(600, buckets, origins, seed=buckets)
+            errors = check_against_reference(docs, bucket_ids, top_k=args.top_k, chunk_rows=args.chunk_rows)
+            print(f"check n=600 buckets={buckets} origins={origins}: {'ok' if not errors else f'{len(errors)} mismatches'}")
+            for line in errors[:10]:
+                print(f"  {line}")
+            failed = failed or bool(errors)
+        if failed:
+            raise SystemExit(1)
+
+    print(f"{'n':>7} {'buckets':>8} {'origins':>8} {'median ms':>10}")
+    for buckets in args.buckets:
+        for origins in (False, True):
+            ms = benchmark(args.n, buckets, origins, args.repeat, args.top_k, args.chunk_rows)
+            print(f"{args.n:>7} {buckets:>8} {origins!s:>8} {ms:>10.1f}")
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""Lightweight per-event tracing.
+
+A trace starts at a root span (e.g. the webhook callback) and is kept only if
+sampled; nested spans, pymongo commands and LINE API calls made inside it are
+recorded and written to a JSONL file when the root span ends. With sampling off
+every hook is a single context-variable lookup.
+
+Summarise the slowest spans with:
+    python tracing.py traces.jsonl --top 20
+"""
+import argparse
+import contextvars
+import functools
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+_current_span = contextvars.ContextVar('current_span', default=None) # (span_id, attrs)
+
+_sample_rate = 0.0
+_exporter = None
+
+# --- Exporter ---
+class JsonlSpanExporter:
+    """Appends finished traces to a JSONL file, one span per line."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, spans):
+        lines = ''.join(json.dumps(s, ensure_ascii=False, default=str) + '\n' for s in spans)
+        with self._lock:
+            try:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(lines)
+            except OSError as e:
+                logger.error(f"Failed to export {len(spans)} spans to {self.path}: {e}")
+
+def configure(sample_rate, export_path):
+    """Sets the root sampling rate (0 disables tracing) and the JSONL export path."""
+    global _sample_rate, _exporter
+    _sample_rate = max(0.0, min(float(sample_rate), 1.0))
+    _exporter = JsonlSpanExporter(export_path) if _sample_rate > 0 else None
+
+# --- Spans ---
+class _Trace:
+    __slots__ = ('trace_id', 'spans')
+
+    def __init__(self):
+        self.trace_id = uuid.uuid4().hex
+        self.spans = []
+
+def _record(trace, name, parent_id, span_id, start, duration, attrs, error=None):
+    span = {
+        'trace_id': trace.trace_id, 'span_id': span_id, 'parent_id': parent_id, 'name': name,
+        'start': start, 'duration_ms': round(duration * 1000, 3), 'attrs': attrs
+    }
+    if error is not None:
+        span['error'] = error
+    trace.spans.append(span)
+
+@contextmanager
+def span(name, **attrs):
+    """Records a child span if a sampled trace is active; otherwise does nothing."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    parent = _current_span.get()
+    parent_id = parent[0] if parent else None
+    span_id = uuid.uuid4().hex[:16]
+    token = _current_span.set((span_id, attrs))
+    start_wall, start = time.time(), time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        _record(trace, name, parent_id, span_id, start_wall, time.perf_counter() - start, attrs, error)
+
+@contextmanager
+def trace_root(name, **attrs):
+    """Starts a new trace (subject to sampling) and exports it when the block exits."""
+    if _exporter is None or _current_trace.get() is not None or random.random() >= _sample_rate:
+        yield
+        return
+    trace = _Trace()
+    trace_token = _current_trace.set(trace)
+    try:
+        with span(name, **attrs):
+            yield
+    finally:
+        _current_trace.reset(trace_token)
+        _exporter.export(trace.spans)
+
+def annotate(**attrs):
+    """Adds attributes to the current span, if any."""
+    current = _current_span.get()
+    if current is not None:
+        current[1].update(attrs)
+
+def traced(name, root=False):
+    """Decorator form of span() / trace_root()."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if root:
+                with trace_root(name):
+                    return func(*args, **kwargs)
+            if _current_trace.get() is None:
+                return func(*args, **kwargs)
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def traced_event_handler(name):
+    """traced() for functions registered with WebhookHandler.add.
+
+    The handler inspects the registered function's argspec and passes
+    (event, destination) to anything taking *args, so the wrapper must keep
+    an explicit single-argument signature.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(event):
+            if _current_trace.get() is None:
+                return func(event)
+            with span(name):
+                return func(event)
+        return wrapper
+    return decorator
+
+# --- pymongo Command Listener ---
+class MongoSpanListener(monitoring.CommandListener):
+    """Records each pymongo command issued inside a sampled trace as a span."""
+
+    def __init__(self):
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        trace = _current_trace.get()
+        if trace is None:
+            return
+        collection = event.command.get(event.command_name)
+        attrs = {'db': event.database_name}
+        if isinstance(collection, str):
+            attrs['collection'] = collection
+        parent = _current_span.get()
+        with self._lock:
+            self._inflight[(event.request_id, event.operation_id)] = (trace, parent[0] if parent else None, time.time(), attrs)
+
+    def _finish(self, event, error=None):
+        if not self._inflight:
+            return
+        with self._lock:
+            entry = self._inflight.pop((event.request_id, event.operation_id), None)
+        if entry is None:
+            return
+        trace, parent_id, start_wall, attrs = entry
+        _record(trace, f"mongo.{event.command_name}", parent_id, uuid.uuid4().hex[:16],
+                start_wall, event.duration_micros / 1e6, attrs, error)
+
+    def succeeded(self, event):
+        self._finish(event)
+
+    def failed(self, event):
+        self._finish(event, error=str(event.failure))
+
+# --- LINE API Instrumentation ---
+LINE_API_METHODS = ['reply_message', 'push_message', 'multicast', 'get_profile']
+
+def instrument_line_api(api):
+    """Wraps the LineBotApi methods this app calls so each call becomes a 'line.<method>' span."""
+    if api is None:
+        return api
+    for method_name in LINE_API_METHODS:
+        method = getattr(api, method_name, None)
+        if method is not None:
+            setattr(api, method_name, traced(f"line.{method_name}")(method))
+    return api
+
+# --- CLI ---
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def summarize(path, top=20):
+    """Prints per-span-name latency stats and the slowest individual spans."""
+    spans = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                spans.append(json.loads(line))
+    if not spans:
+        print("No spans found.")
+        return
+
+    by_name = {}
+    for s in spans:
+        by_name.setdefault(s['name'], []).append(s['duration_ms'])
+    print(f"{'span':<40} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9} {'total ms':>11}")
+    for name, durations in sorted(by_name.items(), key=lambda kv: -sum(kv[1])):
+        durations.sort()
+        print(f"{name:<40} {len(durations):>7} {_percentile(durations, 50):>9.1f} {_percentile(durations, 95):>9.1f} "
+              f"{durations[-1]:>9.1f} {sum(durations):>11.1f}")
+
+    print(f"\nSlowest {top} spans:")
+    for s in sorted(spans, key=lambda s: -s['duration_ms'])[:top]:
+        attrs = ' '.join(f"{k}={v}" for k, v in (s.get('attrs') or {}).items())
+        error = f" ERROR={s['error']}" if s.get('error') else ''
+        print(f"{s['duration_ms']:>9.1f} ms  {s['name']:<32} trace={s['trace_id'][:8]} {attrs}{error}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Summarise spans exported by tracing.JsonlSpanExporter.")
+    parser.add_argument('path', nargs='?', default='traces.jsonl')
+    parser.add_argument('--top', type=int, default=20)
+    args = parser.parse_args()
+    summarize(args.path, args.top)
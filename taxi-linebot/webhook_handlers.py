@@ -7,7 +7,7 @@ from linebot.models import (
     MessageEvent, TextMessage, LocationMessage, PostbackEvent, TextSendMessage
 )
 from pymongo import ReturnDocument, GEOSPHERE # GEOSPHERE might be needed if re-initializing index here
-from datetime import datetime
+from datetime import datetime, timedelta
 import re  # 新增 re 模組引入
 
 # Import db, line_bot_api, handler from app setup
@@ -15,13 +15,23 @@ from app import db, line_bot_api, handler
 # Import logic and templates
 import matching_logic
 from matching_logic import process_pending_matches, show_loading_indicator
+from adaptive_scheduler import cadence
 import message_templates
+import match_membership
+from match_lifecycle import hot_member_filter
+import match_status
+import notification_outbox
+import tracing
+from load_shedding import admission, LEVEL_REDUCED, LEVEL_BUSY, LEVEL_SHED, BUSY_QUEUED_MESSAGE
+from geocoding import geocoder
+from demand_analytics import record_request
 
 logger = logging.getLogger(__name__)
 webhook_bp = Blueprint('webhook', __name__)
 
 # --- Webhook Route ---
 @webhook_bp.route("/callback", methods=['POST'])
+@tracing.traced("webhook.callback", root=True)
 def callback():
     if line_bot_api is None or handler is None:
         logger.critical("Line Bot API/Handler not initialized.")
@@ -39,21 +49,34 @@ def callback():
         logger.error("Missing X-Line-Signature")
         abort(400)
 
-    try:
-        handler.handle(body, signature)
-    except InvalidSignatureError:
-        logger.error("Invalid signature.")
-        abort(400)
-    except LineBotApiError as e:
-        logger.error(f"Line API Error: {e.status_code} {e.error.message}")
-        abort(500) # Internal server error on API failure
-    except Exception as e:
-        logger.exception(f"Unhandled exception in handler: {e}")
-        abort(500)
+    with admission.admit() as level:
+        tracing.annotate(load_level=level)
+        if level >= LEVEL_SHED:
+            # Overloaded: acknowledge now and handle on the deferral pool (reply tokens stay valid for a while)
+            if not handler.parser.signature_validator.validate(body, signature):
+                logger.error("Invalid signature.")
+                abort(400)
+            if admission.defer(current_app._get_current_object(), handler.handle, body, signature):
+                return 'OK'
+            logger.warning("Webhook deferral queue full, rejecting request.")
+            abort(503)
+
+        try:
+            handler.handle(body, signature)
+        except InvalidSignatureError:
+            logger.error("Invalid signature.")
+            abort(400)
+        except LineBotApiError as e:
+            logger.error(f"Line API Error: {e.status_code} {e.error.message}")
+            abort(500) # Internal server error on API failure
+        except Exception as e:
+            logger.exception(f"Unhandled exception in handler: {e}")
+            abort(500)
 
     return 'OK'
 
 # --- Helper to get/create user ---
+@tracing.traced("get_or_create_user")
 def get_or_create_user(user_id):
     """Finds user or creates a basic record, returning the user dict."""
     if db is None: return None # Should not happen if check in callback works
@@ -79,6 +102,7 @@ def reply_message_wrapper(reply_token, message):
 
 # --- Line Event Handlers ---
 @handler.add(MessageEvent, message=TextMessage)
+@tracing.traced_event_handler("handler.message")
 def handle_message(event):
     user_id = event.source.user_id
     text = event.message.text.strip()
@@ -93,28 +117,12 @@ def handle_message(event):
     is_registered = user_name and user_data.get('phone')
 
     # 檢查是否為隊長正在等待輸入車牌
-    active_match_as_leader = db.matches.find_one({
-        'leader_id': user_id,
-        'status': message_templates.STATE_AWAITING_PLATE
-    })
-
-    if active_match_as_leader:
-        license_plate = text.upper().replace("-", "").replace(" ", "")
-
-        if re.fullmatch(r"^[A-Z0-9]{2,4}[A-Z0-9]{3,4}$", license_plate):
-            match_id = active_match_as_leader['group_id']
-            members = active_match_as_leader.get('members', [])
-            other_members = [m for m in members if m != user_id]
-
-            # 更新資料庫中的配對記錄
-            db.matches.update_one(
-                {'group_id': match_id},
-                {'$set': {
-                    'license_plate': license_plate,
-                    'status': message_templates.MATCH_STATUS_ACTIVE
-                }}
-            )
-            logger.info(f"Leader {user_id} provided license plate {license_plate} for match {match_id}")
+    # 格式正確時直接以條件更新登記（單次往返），僅在格式錯誤時才查詢是否為隊長
+    license_plate = text.upper().replace("-", "").replace(" ", "")
+    if re.fullmatch(r"^[A-Z0-9]{2,4}[A-Z0-9]{3,4}$", license_plate):
+        updated_match = match_membership.register_license_plate(user_id, license_plate)
+        if updated_match:
+            other_members = [m for m in updated_match.get('members', []) if m != user_id]
 
             # 通知隊長成功
             reply_message_wrapper(reply_token, TextSendMessage(text=f"✅ 車牌號碼 {license_plate} 已登記並通知隊員。"))
@@ -122,18 +130,13 @@ def handle_message(event):
             # 通知其他成員
             leader_name = user_data.get('name', '隊長')
             plate_message = message_templates.create_license_plate_notification(leader_name, license_plate)
-            if line_bot_api:
-                for member_id in other_members:
-                    try:
-                        line_bot_api.push_message(member_id, plate_message)
-                    except Exception as e:
-                        logger.error(f"Failed to send license plate notification to member {member_id} for match {match_id}: {e}")
+            notification_outbox.enqueue(other_members, plate_message, 'license_plate')
             return
 
-        else:
-            # 格式無效
-            reply_message_wrapper(reply_token, TextSendMessage(text="⚠️ 車牌號碼格式似乎不正確，請重新輸入 (例如 ABC-1234)。"))
-            return
+    elif match_membership.is_awaiting_plate(user_id):
+        # 格式無效
+        reply_message_wrapper(reply_token, TextSendMessage(text="⚠️ 車牌號碼格式似乎不正確，請重新輸入 (例如 ABC-1234)。"))
+        return
 
     # --- State Machine ---
     if current_state == message_templates.STATE_AWAITING_REG_NAME:
@@ -198,6 +201,7 @@ def handle_message(event):
 
 
 @handler.add(MessageEvent, message=LocationMessage)
+@tracing.traced_event_handler("handler.location")
 def handle_location(event):
     user_id = event.source.user_id
     reply_token = event.reply_token
@@ -212,7 +216,12 @@ def handle_location(event):
     if is_registered and user_data.get('state') == message_templates.STATE_AWAITING_DESTINATION:
         lat = event.message.latitude
         lon = event.message.longitude
-        addr = event.message.address or f"經緯度: {lat:.5f}, {lon:.5f}"
+        if event.message.address:
+            addr = event.message.address
+            geocoder.remember(lat, lon, addr)
+        else:
+            # 負載偏高時只查快取，不呼叫外部 API
+            addr = geocoder.reverse(lat, lon, allow_remote=admission.level() < LEVEL_REDUCED) or f"經緯度: {lat:.5f}, {lon:.5f}"
         update_data = {
             'destination': [lon, lat], 'location': {'type': 'Point', 'coordinates': [lon, lat]},
             'address': addr, 'state': message_templates.STATE_AWAITING_PASSENGERS
@@ -222,10 +231,15 @@ def handle_location(event):
         reply_message_wrapper(reply_token, messages)
     elif not is_registered:
         reply_message_wrapper(reply_token, TextSendMessage(text="請先完成註冊才能設定目的地喔！"))
-    else: # Registered but not in correct state
-        reply_message_wrapper(reply_token, TextSendMessage(text="如果您想設定目的地，請先點選主選單的 '設定目的地' 按鈕。"))
+    else: # Registered but not setting a destination: treat the shared location as the pickup point
+        pickup = [event.message.longitude, event.message.latitude]
+        db.users.update_one({'line_user_id': user_id}, {'$set': {'pickup': pickup, 'pickup_at': datetime.now()}})
+        # Already queued riders get it too, so route scoring can weigh their detour
+        db.pending_matches.update_one({'line_user_id': user_id}, {'$set': {'origin': pickup}})
+        reply_message_wrapper(reply_token, message_templates.create_pickup_saved())
 
 @handler.add(PostbackEvent)
+@tracing.traced_event_handler("handler.postback")
 def handle_postback(event):
     user_id = event.source.user_id
     data = event.postback.data
@@ -233,6 +247,7 @@ def handle_postback(event):
 
 
 # --- Common Handler for Postbacks and Keywords ---
+@tracing.traced("postback_action")
 def handle_postback_action(event, user_id, data):
     reply_token = event.reply_token
 
@@ -245,6 +260,7 @@ def handle_postback_action(event, user_id, data):
     user_name = user_data.get('name', '朋友')
 
     action = data.split('&')[0]
+    tracing.annotate(action=action)
 
     if action == 'action=register':
         if is_registered:
@@ -271,22 +287,37 @@ def handle_postback_action(event, user_id, data):
             reply_message_wrapper(reply_token, TextSendMessage(text='⚠️ 請先透過「設定目的地」完成地點和人數設定，才能開始配對。'))
         elif db.pending_matches.find_one({'line_user_id': user_id}):
              reply_message_wrapper(reply_token, TextSendMessage(text="您目前已經在配對佇列中了，請稍候..."))
-        elif db.matches.find_one({'members': user_id, 'status': message_templates.MATCH_STATUS_ACTIVE}):
+        elif db.matches.find_one(hot_member_filter(user_id), {'_id': 1}):
              reply_message_wrapper(reply_token, TextSendMessage(text="您目前已經在一個進行中的共乘隊伍裡了！"))
         else:
             # Add to pending
-            db.pending_matches.insert_one({
+            pending_doc = {
                 'line_user_id': user_id, 'destination': user_data['destination'],
                 'passengers': user_data['passengers'], 'timestamp': datetime.now()
-            })
+            }
+            pickup_at = user_data.get('pickup_at')
+            if user_data.get('pickup') and pickup_at and pending_doc['timestamp'] - pickup_at <= timedelta(minutes=current_app.config['PICKUP_MAX_AGE_MINUTES']):
+                pending_doc['origin'] = user_data['pickup']
+            db.pending_matches.insert_one(pending_doc)
+            admission.note_pending(1)
             logger.info(f"User {user_id} added to pending list.")
+            record_request(db, pending_doc, current_app.config['ANALYTICS_CELL_PRECISION'])
+            cadence.notify_arrival()
+            match_status.broker.publish(user_id, match_status.STATUS_SEARCHING)
+
+            level = admission.level()
+            if level >= LEVEL_BUSY:
+                # 高負載：略過載入指示器，直接回覆預先建立的排隊訊息
+                reply_message_wrapper(reply_token, BUSY_QUEUED_MESSAGE)
+                return
 
-            # 顯示 LINE 官方載入指示器（30秒）
-            show_loading_indicator(user_id, seconds=30)
+            # 顯示 LINE 官方載入指示器（30秒）；負載偏高時略過這次 HTTP 呼叫
+            if level < LEVEL_REDUCED:
+                show_loading_indicator(user_id, seconds=30)
 
             # 立即回覆確認訊息（Flex Message）
             interval_minutes = current_app.config['MATCH_INTERVAL_MINUTES']
-            message = message_templates.create_searching_flex(interval_minutes)
+            message = message_templates.create_searching_flex(interval_minutes, current_app.config.get('LIFF_STATUS_URL'))
             reply_message_wrapper(reply_token, message)
 
     elif action == 'action=help':
@@ -296,7 +327,9 @@ def handle_postback_action(event, user_id, data):
     elif action == 'action=cancel_pending_match':
         result = db.pending_matches.delete_one({'line_user_id': user_id})
         if result.deleted_count > 0:
+            admission.note_pending(-1)
             logger.info(f"User {user_id} cancelled pending match request.")
+            match_status.broker.publish(user_id, match_status.STATUS_CANCELLED)
             reply_message_wrapper(reply_token, TextSendMessage(text="✅ 已取消本次的配對搜尋。"))
         else:
             reply_message_wrapper(reply_token, TextSendMessage(text="⚠️ 您目前沒有在等待配對的請求，或請求已被處理。"))
@@ -304,29 +337,25 @@ def handle_postback_action(event, user_id, data):
     elif action == 'action=cancel_successful_match':
         try:
             match_id = data.split('&match_id=')[1]
-            match = db.matches.find_one({'group_id': match_id, 'status': message_templates.MATCH_STATUS_ACTIVE})
+            # Leave + cancel-on-underflow happen in one atomic update; notifications use the returned document.
+            outcome, updated_match = match_membership.leave_match(match_id, user_id)
 
-            if match and user_id in match.get('members', []):
-                # Remove member
-                db.matches.update_one({'group_id': match_id}, {'$pull': {'members': user_id}})
-                logger.info(f"User {user_id} left match {match_id}")
+            if outcome in (match_membership.LEAVE_OK, match_membership.LEAVE_CANCELLED):
                 reply_message_wrapper(reply_token, TextSendMessage(text="✅ 您已成功退出此次共乘。"))
+                remaining_members = updated_match.get('members', [])
+                match_status.broker.publish(user_id, match_status.STATUS_LEFT, group_id=match_id)
 
-                # Check remaining and notify others
-                updated_match = db.matches.find_one({'group_id': match_id})
-                remaining_members = updated_match.get('members', []) if updated_match else []
-
-                if len(remaining_members) <= 1:
-                    logger.info(f"Match {match_id} cancelled due to insufficient members.")
-                    db.matches.update_one({'group_id': match_id}, {'$set': {'status': message_templates.MATCH_STATUS_CANCELLED, 'members': remaining_members}})
-                    for member_id in remaining_members:
-                        if line_bot_api: line_bot_api.push_message(member_id, message_templates.create_match_cancelled_message(match_id))
+                if outcome == match_membership.LEAVE_CANCELLED:
+                    match_status.broker.publish_many(remaining_members, match_status.STATUS_MATCH_CANCELLED, group_id=match_id)
+                    notification_outbox.enqueue(remaining_members, message_templates.create_match_cancelled_message(match_id), 'match_cancelled')
                 else:
                     leaver_name = user_data.get('name', '一位夥伴')
-                    for member_id in remaining_members:
-                        if line_bot_api: line_bot_api.push_message(member_id, message_templates.create_member_left_message(match_id, leaver_name, len(remaining_members)))
+                    notification_outbox.enqueue(remaining_members, message_templates.create_member_left_message(match_id, leaver_name, len(remaining_members)), 'member_left')
+                    # 隊長在提供車牌前退出：請新隊長接手輸入車牌
+                    if updated_match.get('previous_leader_id') == user_id and updated_match.get('status') == message_templates.STATE_AWAITING_PLATE:
+                        notification_outbox.enqueue([updated_match['leader_id']], message_templates.create_new_leader_message(match_id), 'new_leader')
 
-            elif match and user_id not in match.get('members', []):
+            elif outcome == match_membership.LEAVE_NOT_MEMBER:
                 reply_message_wrapper(reply_token, TextSendMessage(text="您已不在這個共乘隊伍中了。"))
             else:
                 reply_message_wrapper(reply_token, TextSendMessage(text="❌ 找不到指定的配對記錄，或該配對已結束/取消。"))